@@ -1,36 +1,70 @@
 from mandelbrot import Mandelbrot
+from mandelbrot.compat import xrange
 from mandelbrot.generators import NumexprGenerator, PerturbedGenerator
-from mandelbrot.renderers import PILRenderer
+from mandelbrot.renderers import PILRenderer, NumpyRenderer
 from mandelbrot.palettes import blue_black_orange_white
-from mandelbrot.tile_managers import CachelessTileManager, NumpyCompressedTileManager, ZODBTileManager
+from mandelbrot.tile_managers import CachelessTileManager, ZODBTileManager, SQLiteTileManager
+from mandelbrot.video import KeyframeZoom, FrameScheduler
 
 from moviepy.video.VideoClip import VideoClip
+from moviepy.video.io.ffmpeg_writer import FFMPEG_VideoWriter
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 
-def render_video(destination, start_z, end_z, size, duration, fps, filename):
-    proc = Mandelbrot(
-        renderer=PILRenderer,
-        size=size,
+def render_video(destination, start_z, end_z, size, duration, fps, filename,
+                 generator=NumexprGenerator, iterations=100, spacing=None, crossfade=0, workers=None):
+    """
+    Given a spacing the frames are scaled out of keyframes spacing z apart, see mandelbrot.video
+    Given workers the frames are rendered in full across that many processes sharing an SQLite tile cache and streamed
+    to ffmpeg in order, spacing is ignored
+    """
+    mandelbrot_kwargs = dict(
+        # Hands moviepy the same frame buffer every time, it is written out before the next frame is rendered
+        renderer=NumpyRenderer,
         palette=blue_black_orange_white(cycle_size=30),
         max_color=(0, 0, 0),
         tile_manager=ZODBTileManager,
-        generator=NumexprGenerator,
-        iterations=100,
+        generator=generator,
+        iterations=iterations,
         tile_size=512
     )
 
-    def gen_frame(t):
-        log.debug("Making frame at t={}".format(t))
+    def z_at(t):
         if duration:
             z_t = end_z - (start_z - end_z) * (t-duration)/duration
             log.debug("Z: {}".format(z_t))
         else:
             z_t = 0
+        return z_t
+
+    if workers:
+        # ZODB's FileStorage only opens in one process at a time
+        mandelbrot_kwargs['tile_manager'] = SQLiteTileManager
+        scheduler = FrameScheduler(workers, size=size, **mandelbrot_kwargs)
+        writer = FFMPEG_VideoWriter(filename, size, fps, preset='medium', threads=3)
+        try:
+            frame_count = max(int(duration * fps), 1)
+            frames = ((destination[0], destination[1], z_at(i / float(fps))) for i in xrange(frame_count))
+            for frame in scheduler.render_frames(frames):
+                writer.write_frame(frame)
+        finally:
+            writer.close()
+            scheduler.close()
+        return
+
+    if spacing:
+        zoom = KeyframeZoom(destination[0], destination[1], start_z, size=size, spacing=spacing, crossfade=crossfade,
+                            **mandelbrot_kwargs)
+        render_z = zoom.render_frame
+    else:
+        proc = Mandelbrot(size=size, **mandelbrot_kwargs)
+        render_z = lambda z: proc.render_frame(destination[0], destination[1], z)
 
-        return proc.render_frame(destination[0], destination[1], z_t)
+    def gen_frame(t):
+        log.debug("Making frame at t={}".format(t))
+        return render_z(z_at(t))
 
     VideoClip(duration=duration)\
         .set_make_frame(gen_frame)\
@@ -66,5 +100,21 @@ render_video(destination=(-0.7483306070963540, 0.1492396240234374),
              size=(1280, 720),
              duration=10,
              fps=60,
-             filename='NewZoom.mp4')
+             filename='NewZoom.mp4',
+             spacing=1,
+             crossfade=0.25)
+"""
+
+# NumexprGenerator runs out of precision around z=45, PerturbedGenerator keeps going
+# Give the destination as strings so it keeps all its digits
+"""
+render_video(destination=('-0.743643887037158704752191506114774', '0.131825904205311970493132056385139'),
+             start_z=-3,
+             end_z=100,
+             size=(1280, 720),
+             duration=60,
+             fps=60,
+             filename='DeepZoom.mp4',
+             generator=PerturbedGenerator,
+             iterations=5000)
 """
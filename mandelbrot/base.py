@@ -1,4 +1,11 @@
-from .util import transform_index
+from .util import transform_index, tile_children, tile_parent, tile_mirror, elide_uniform
+from .compat import xrange
+from collections import OrderedDict
+from hashlib import md5
+import errno
+import os
+import threading
+import numpy as np
 
 
 class ToImplement(Exception):
@@ -6,19 +13,427 @@ class ToImplement(Exception):
 
 
 class TileManager(object):
-    def __init__(self, generator):
+    # Worker processes generating the misses of get_tiles_data, None generates them in this process
+    workers = None
+    # How many misses go to the generator at once, see Generator.generate_tiles
+    batch_size = 8
+    # Keep the orbits of the pixels that have not escaped, so asking for more iterations carries on from them
+    # The state is then the only copy of a tile. Tiles are resumed one at a time in this process, so it cannot be
+    # combined with workers, and batch_size does not apply
+    resumable = False
+    # Build missing tiles out of stored tiles on the next zoom levels, needs an aligned generator
+    reuse_pyramid = False
+    # Directory of lock files that keep other processes sharing the store from generating the same tile at once, None
+    # only coalesces the threads of this process
+    lock_root = None
+    # Tiles share lock files by hash of their key, so the directory stays this many files
+    lock_stripes = 256
+    # The set is symmetric about the real axis, tiles below it are served upside down from their mirror above it
+    mirror_real_axis = True
+
+    def __init__(self, generator, workers=None, lock_root=None):
         self.generator = generator
+        if workers is not None:
+            self.workers = workers
+        if lock_root is not None:
+            self.lock_root = lock_root
+        self.pool = None
+        self.check_resumable()
+
+        # Tile key to the Flight of the thread generating it
+        self.flights = {}
+        self.flight_lock = threading.Lock()
+        # Times a caller waited for a tile another thread or process was generating
+        self.waits = 0
+        # Times a caller waited for another process that then did not store the tile, and generated it again
+        self.lost_work = 0
+
+    @property
+    def flight_stats(self):
+        return {'waits': self.waits, 'lost_work': self.lost_work, 'in_flight': len(self.flights)}
+
+    def check_resumable(self):
+        if self.resumable and self.workers:
+            raise ValueError("resumable tiles are resumed in this process, they cannot be generated by workers")
 
     def generate_tile_data(self, tile):
         return self.generator.generate_tile(tile.x, tile.y, tile.z)
 
+    def generate_tiles_data(self, tiles):
+        """
+        Yields (tile, data) for every tile, in whatever order they get done
+        """
+        if self.resumable:
+            # resumable may be set after __init__
+            self.check_resumable()
+            for tile in tiles:
+                yield tile, self.resume_tile_data(tile)
+            return
+
+        if not self.workers or len(tiles) < 2:
+            for start in xrange(0, len(tiles), self.batch_size):
+                batch = tiles[start:start + self.batch_size]
+                for tile, data in zip(batch, self.generator.generate_tiles([(t.x, t.y, t.z) for t in batch])):
+                    yield tile, data
+            return
+
+        if self.pool is None:
+            from .pool import TilePool
+            self.pool = TilePool(self.generator, self.workers, self.batch_size)
+
+        for tile, data in self.pool.generate_tiles(tiles):
+            yield tile, data
+
+    def resume_tile_data(self, tile):
+        """
+        Carries the stored state of tile on to the generator's iterations, or cuts it back when it went further
+        """
+        iterations = self.generator.iterations
+        state = self.load_tile_state(tile)
+
+        if state is not None and state.iterations >= iterations:
+            # Pixels that escaped at or after iterations never escape at iterations
+            return np.minimum(state.escape, iterations)
+
+        state = self.generator.generate_tile_state(tile.x, tile.y, tile.z, state)
+        self.store_tile_state(tile, state)
+        return state.escape
+
+    def derive_tile_data(self, tile):
+        """
+        Builds tile out of its four stored children, or a quarter of it out of its stored parent
+
+        Aligned tiles at z hold every other pixel, both ways, of the tiles at z+1. Returns None when neither the
+        children nor the parent are stored.
+        """
+        if not (self.reuse_pyramid and self.generator.aligned):
+            return None
+
+        tile_size = self.generator.tile_size
+        half = tile_size // 2
+
+        children = [self.load_tile_data(child) for child in tile_children(tile)]
+        if all(child is not None for child in children):
+            top_left, top_right, bottom_left, bottom_right = children
+            data = np.empty((tile_size, tile_size), top_left.dtype)
+            data[:half, :half] = top_left[::2, ::2]
+            data[:half, half:] = top_right[::2, ::2]
+            data[half:, :half] = bottom_left[::2, ::2]
+            data[half:, half:] = bottom_right[::2, ::2]
+            return data
+
+        parent, row, col = tile_parent(tile)
+        parent_data = self.load_tile_data(parent)
+        if parent_data is not None:
+            escape = np.empty((tile_size, tile_size), parent_data.dtype)
+            known = np.zeros((tile_size, tile_size), 'bool')
+            escape[::2, ::2] = parent_data[row*half:(row+1)*half, col*half:(col+1)*half]
+            known[::2, ::2] = True
+            return self.generator.complete_tile(tile.x, tile.y, tile.z, escape, known)
+
     def get_tile_key(self, tile):
         # This is potentially irreversible (use a hash function to store x, y, z)
-        return "mandelbrotX{}Y{}Z{}D{}I{}".format(tile.x, tile.y, tile.z, self.generator.tile_size, self.generator.iterations)
+        return "mandelbrotX{}Y{}Z{}D{}I{}{}".format(tile.x, tile.y, tile.z, self.generator.tile_size, self.generator.iterations,
+                                                   'A' if self.generator.aligned else '')
+
+    def get_state_key(self, tile):
+        # A tile's state outlives any iteration count
+        return "mandelbrotX{}Y{}Z{}D{}S{}".format(tile.x, tile.y, tile.z, self.generator.tile_size,
+                                                 'A' if self.generator.aligned else '')
+
+    def make_tile_data(self, tile):
+        """
+        Derives, resumes or generates tile, then stores it
+        """
+        data = self.derive_tile_data(tile)
+        if data is None and self.resumable:
+            # Resuming stored the state, which holds the tile already
+            return elide_uniform(self.resume_tile_data(tile))
+        if data is None:
+            data = self.generate_tile_data(tile)
+        data = elide_uniform(data)
+        self.store_tile_data(tile, data)
+        return data
+
+    def join_flight(self, key):
+        """
+        Returns (flight, leading), the caller leading a flight has to land it
+        """
+        with self.flight_lock:
+            flight = self.flights.get(key)
+            if flight is not None:
+                self.waits += 1
+                return flight, False
+            flight = self.flights[key] = Flight()
+            return flight, True
+
+    def land_flight(self, key, flight, data=None):
+        # Waiters that find no data make the tile themselves
+        with self.flight_lock:
+            del self.flights[key]
+        flight.data = data
+        flight.landed.set()
+
+    def lock_stripe(self, key):
+        return int(md5(key.encode('ascii')).hexdigest(), 16) % self.lock_stripes
+
+    def lock_file(self, key):
+        """
+        Opens the lock file key hashes to, None when there is no lock_root
+        """
+        if self.lock_root is None:
+            return None
+        if not os.path.isdir(self.lock_root):
+            try:
+                os.makedirs(self.lock_root)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        return open(os.path.join(self.lock_root, '{}.lock'.format(self.lock_stripe(key))), 'a+')
+
+    @staticmethod
+    def try_lock(lock_file, keys):
+        """
+        Takes lock_file without blocking and writes the keys being generated into it, False if another process has it
+        """
+        # Only needed with a lock_root, the rest works where there is no fcntl
+        import fcntl
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        lock_file.truncate(0)
+        lock_file.write('\n'.join(keys))
+        lock_file.flush()
+        return True
+
+    def make_locked_tile_data(self, tile, key):
+        """
+        Makes tile holding its lock file, when another process holds it waits and takes what that process stored
+        """
+        lock_file = self.lock_file(key)
+        if lock_file is None:
+            return self.make_tile_data(tile)
+
+        import fcntl
+        with lock_file:
+            if not self.try_lock(lock_file, [key]):
+                with self.flight_lock:
+                    self.waits += 1
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                data = self.load_tile_data(tile)
+                if data is not None:
+                    return data
+
+                # The lock file still names what the last holder generated, other tiles just share the file
+                lock_file.seek(0)
+                if key in lock_file.read().split():
+                    with self.flight_lock:
+                        self.lost_work += 1
+                self.try_lock(lock_file, [key])
+            # Another process may have stored it between the miss and taking the lock
+            data = self.load_tile_data(tile)
+            if data is not None:
+                return data
+            return self.make_tile_data(tile)
+
+    def canonical_tile(self, tile):
+        """
+        Returns (the tile whose data stands for tile, whether tile is that data upside down)
+
+        Aligned tiles leave out their bottom row rather than their top one, their mirror would be a row off, so they
+        always stand for themselves.
+        """
+        if self.mirror_real_axis and not self.generator.aligned and tile.y < 1:
+            return tile_mirror(tile), True
+        return tile, False
+
+    def mirrored(self, tiles, get_tiles_data):
+        """
+        Asks get_tiles_data for the canonical tile of every tile, once each, and yields (tile, data) for every tile
+        """
+        requested = OrderedDict()
+        for tile in tiles:
+            canonical, flipped = self.canonical_tile(tile)
+            requested.setdefault((canonical.x, canonical.y, canonical.z), (canonical, []))[1].append((tile, flipped))
+
+        for canonical, data in get_tiles_data([canonical for canonical, _ in requested.values()]):
+            for tile, flipped in requested[canonical.x, canonical.y, canonical.z][1]:
+                yield tile, data[::-1] if flipped else data
 
     def get_tile_data(self, tile):
+        """
+        Loads tile, or makes it once however many threads, and processes sharing a lock_root, ask at the same time
+        """
+        tile, flipped = self.canonical_tile(tile)
+        if flipped:
+            return self.get_tile_data(tile)[::-1]
+
+        data = self.load_tile_data(tile)
+        if data is not None:
+            return data
+
+        key = self.get_tile_key(tile)
+        flight, leading = self.join_flight(key)
+        if not leading:
+            flight.landed.wait()
+            if flight.data is not None:
+                return flight.data
+            return self.get_tile_data(tile)
+
+        try:
+            data = self.make_locked_tile_data(tile, key)
+        finally:
+            self.land_flight(key, flight, data)
+        return data
+
+    def get_tiles_data(self, tiles):
+        """
+        Yields (tile, data) for every tile, the stored ones first and then the misses as they are generated
+
+        Misses another thread or process is already generating are waited for last, see get_tile_data.
+        Tiles whose pixels all match come back as a uniform_tile, see util.uniform_value.
+        """
+        return self.mirrored(tiles, self.get_canonical_tiles_data)
+
+    def get_canonical_tiles_data(self, tiles):
+        misses = []
+        for tile in tiles:
+            data = self.load_tile_data(tile)
+            if data is None:
+                misses.append(tile)
+            else:
+                yield tile, data
+
+        # Claim every miss nobody else is on, lock files are shared by every claimed tile that hashes to them
+        claimed = {}
+        # (tile, the flight of the thread making it, or None when another process has it)
+        others = []
+        # Claimed key to the lock file of its stripe, shared by every claimed key of the stripe
+        locks = {}
+
+        def unlock(key):
+            # A stripe is let go once its last tile is stored, before the caller gets it, so a slow caller does not
+            # hold up other threads and processes whose tiles share the stripe
+            lock_file = locks.pop(key, None)
+            if lock_file is not None and not any(other is lock_file for other in locks.values()):
+                lock_file.close()
+
+        try:
+            for tile in misses:
+                key = self.get_tile_key(tile)
+                flight, leading = self.join_flight(key)
+                if not leading:
+                    others.append((tile, flight))
+                    continue
+                claimed[key] = tile, flight
+
+            if self.lock_root is not None:
+                stripes = {}
+                for key in claimed:
+                    stripes.setdefault(self.lock_stripe(key), []).append(key)
+                for keys in stripes.values():
+                    lock_file = self.lock_file(keys[0])
+                    if self.try_lock(lock_file, keys):
+                        for key in keys:
+                            locks[key] = lock_file
+                        continue
+                    lock_file.close()
+                    # Another process has these, get_tile_data waits for it
+                    for key in keys:
+                        tile, flight = claimed.pop(key)
+                        self.land_flight(key, flight)
+                        others.append((tile, None))
+
+            derived = []
+            for key, (tile, flight) in list(claimed.items()):
+                data = self.load_tile_data(tile) if self.lock_root is not None else None
+                if data is None:
+                    data = self.derive_tile_data(tile)
+                    if data is None:
+                        continue
+                    data = elide_uniform(data)
+                    self.store_tile_data(tile, data)
+                derived.append((key, tile, data))
+
+            for key, tile, data in derived:
+                self.land_flight(key, claimed.pop(key)[1], data)
+                unlock(key)
+                yield tile, data
+
+            tiles_by_key = dict((key, tile) for key, (tile, _) in claimed.items())
+            for tile, data in self.generate_tiles_data(list(tiles_by_key.values())):
+                data = elide_uniform(data)
+                if not self.resumable:
+                    self.store_tile_data(tile, data)
+                key = self.get_tile_key(tile)
+                self.land_flight(key, claimed.pop(key)[1], data)
+                unlock(key)
+                yield tile, data
+        finally:
+            for key, (tile, flight) in claimed.items():
+                self.land_flight(key, flight)
+            for key in list(locks):
+                unlock(key)
+
+        for tile, flight in others:
+            data = None
+            if flight is not None:
+                flight.landed.wait()
+                data = flight.data
+            yield tile, data if data is not None else self.get_tile_data(tile)
+
+    def has_tile_data(self, tile):
+        """
+        Whether get_tile_data would find tile, or the tile it is mirrored from, already stored
+        """
+        tile = self.canonical_tile(tile)[0]
+        if self.tile_stored(tile):
+            return True
+        if self.resumable:
+            state = self.load_tile_state(tile)
+            return state is not None and state.iterations >= self.generator.iterations
+        return False
+
+    def tile_stored(self, tile):
+        # Backends that can tell without loading the tile override this
+        return self.load_tile_data(tile) is not None
+
+    def load_tile_data(self, tile):
+        """
+        Returns the stored data for tile, None if there is none
+        """
+        raise ToImplement
+
+    def store_tile_data(self, tile, data):
+        raise ToImplement
+
+    def load_tile_state(self, tile):
+        """
+        Returns the stored TileState for tile, None if there is none
+        """
         raise ToImplement
 
+    def store_tile_state(self, tile, state):
+        raise ToImplement
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+
+class Flight(object):
+    """
+    A tile one thread is making, the others wait for it to land
+    """
+
+    def __init__(self):
+        self.landed = threading.Event()
+        self.data = None
+
 
 class Renderer(object):
     def __init__(self, size, palette, max_color, tile_manager):
@@ -36,15 +451,47 @@ class Generator(object):
     """
     A stub generator that doesn't do much
     """
+    # Sample the left and top edges of a tile but not the right and bottom ones, which belong to the next tiles
+    # That way every pixel of a tile is also a pixel of one of its children, see TileManager.reuse_pyramid
+    aligned = False
+
     def __init__(self, iterations, tile_size):
         self.iterations = iterations
         self.tile_size = tile_size
 
-    def generate_tile(self, x, y, z):
+    def tile_region(self, x, y, z):
         u0, v0 = transform_index(x, y, z)
         u1, v1 = transform_index(x+1, y-1, z)
 
-        return self.generate_region(u0, u1, v0, v1)
+        return u0, u1, v0, v1
+
+    def sample_axes(self, u0, u1, v0, v1):
+        """
+        The u and v of the tile_size samples along each side of a region
+        """
+        endpoint = not self.aligned
+        return np.linspace(u0, u1, self.tile_size, endpoint=endpoint), np.linspace(v0, v1, self.tile_size, endpoint=endpoint)
+
+    def generate_tile(self, x, y, z):
+        return self.generate_region(*self.tile_region(x, y, z))
+
+    def complete_tile(self, x, y, z, escape, known):
+        """
+        Fills in the pixels of escape that are not known, generators that cannot compute a subset redo the whole tile
+        """
+        return self.generate_tile(x, y, z)
+
+    def generate_tiles(self, tiles):
+        """
+        Generates every (x, y, z) in tiles, returns their data in the same order
+        """
+        return [self.generate_tile(x, y, z) for x, y, z in tiles]
+
+    def generate_tile_state(self, x, y, z, state=None):
+        """
+        Returns a TileState for the tile at self.iterations, carrying on from state if given
+        """
+        raise ToImplement
 
     def generate_region(self, u0, u1, v0, v1):
         raise ToImplement
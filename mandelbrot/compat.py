@@ -0,0 +1,12 @@
+"""
+Names that moved between Python 2 and Python 3, the tile server only runs on Python 3
+"""
+try:
+    xrange = xrange
+except NameError:
+    xrange = range
+
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
@@ -1,10 +1,12 @@
 from __future__ import division
-from math import floor, ceil
+from fractions import Fraction
+from math import ceil
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
-from .util import transform_real, RenderSet, DataTile
+from .util import RenderSet, DataTile
+from .compat import xrange
 
 """
 Composers take tiles and put them together, applying a palette in the process
@@ -26,8 +28,8 @@ class Composer(object):
         """
         Generates a ViewPort containing tiles that are required to fit a viewport at u, v
         using the classes width, height, and tile_size
-        :param u: x-like component of the fractal
-        :param v: y-like component of the fractal
+        :param u: x-like component of the fractal, anything Fraction takes, a decimal string for deep zooms
+        :param v: y-like component of the fractal, anything Fraction takes, a decimal string for deep zooms
         :param z: viewport z
         :return: ViewPort: A ViewPort of the above
         """
@@ -38,22 +40,23 @@ class Composer(object):
         # The z value of tiles that are at >= resolution the z value specified
         tile_z = int(ceil(z))
 
-        # Transform the u v coordinates into index space
-        x, y = transform_real(u, v, tile_z)
+        # Transform the u v coordinates into index space, exactly, doubles lose the pixels within a tile past z~40
+        scale = Fraction(2)**tile_z
+        x, y = scale*Fraction(u), scale*Fraction(v)
 
         # Half the screen width in tile_size units
-        half_index_width = w/base_tile_size/2
-        half_index_height = h/base_tile_size/2
+        half_index_width = Fraction(w, base_tile_size*2)
+        half_index_height = Fraction(h, base_tile_size*2)
 
         # The floors of the window bounds
-        min_x, max_x = int(floor(x - half_index_width)), int(floor(x + half_index_width))
-        min_y, max_y = int(ceil(y - half_index_height)), int(ceil(y + half_index_height))
+        min_x, max_x = int((x - half_index_width) // 1), int((x + half_index_width) // 1)
+        min_y, max_y = -int((half_index_height - y) // 1), -int((-half_index_height - y) // 1)
 
         log.debug("""Generating tile_list
                   X, Y = {}, {}
                   {}x{}
                   X: {}->{}
-                  Y: {}->{}""".format(x, y, w, h, min_x, max_x, min_y, max_y))
+                  Y: {}->{}""".format(float(x), float(y), w, h, min_x, max_x, min_y, max_y))
 
         # The list of tiles you need to fill out the requested viewport
         return self.layout_tiles(z, tile_z, x, y,
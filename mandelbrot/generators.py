@@ -3,14 +3,112 @@ This module generates mandelbrot data
 """
 from collections import namedtuple
 from .base import Generator
+from .compat import xrange
+from .util import TileState
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
 
 ComplexTile = namedtuple('ComplexTile', 'u0 u1 v0 v1 step_size')
 
+from fractions import Fraction
+from math import ldexp
 import numexpr as ne
 import numpy as np
+from .perturbation import ReferenceOrbit, ReferenceOrbitStore, perturbed_escape_time, required_precision
+
+# Orbits that come back to within this fraction of the pixel spacing of a saved point are cyclic. A fixed distance
+# would be wider than whole pixels on deep zooms and take escaping pixels near the boundary for interior ones
+PERIODICITY_TOLERANCE = 1e-10
+
+
+def in_cardioid_or_bulb(c):
+    """
+    Marks the points of c in the main cardioid or the period-2 bulb, which never escape
+    """
+    x, y = c.real, c.imag
+    q = (x - 0.25)**2 + y**2
+    return (q * (q + (x - 0.25)) <= 0.25 * y**2) | ((x + 1)**2 + y**2 <= 0.0625)
+
+
+def compact_escape_time(c, iterations, compact_fraction=0.25, interior_check=True, periodicity_tolerance=None,
+                        z=None, start=1, return_state=False):
+    """
+    Iterate z**2+c over every point of c, keeping only the still-live points packed together
+
+    Escaped points are parked at z = c = 0 until they make up compact_fraction of the packed arrays, then the arrays
+    are shrunk. Iteration stops as soon as nothing is left alive.
+    Points in the cardioid or the period-2 bulb are never iterated, and orbits that come back to within
+    periodicity_tolerance of a saved point (Brent's cycle detection) are retired as interior.
+    :param c: complex128 array of points, any shape
+    :param iterations: maximum iterations
+    :param compact_fraction: fraction of dead points tolerated in the packed arrays before shrinking them
+    :param interior_check: skip the points in_cardioid_or_bulb
+    :param periodicity_tolerance: distance at which an orbit counts as cyclic, PERIODICITY_TOLERANCE of the pixel
+        spacing is a safe one, None to iterate every orbit out
+    :param z: where the orbits are after start-1 iterations, zeros by default
+    :param start: the first iteration to run
+    :param return_state: also return the flat indices of the points still being iterated and their z
+    :return: int32 escape counts shaped like c, iterations for points that never escaped
+    """
+    escape = np.empty(c.shape, 'int32')
+    escape[...] = iterations
+    escape_flat = escape.reshape(-1)
+
+    # The flat indices of the packed points
+    live = np.arange(c.size)
+    c = np.array(c, 'complex128').reshape(-1)
+    z = np.zeros_like(c) if z is None else np.array(z, 'complex128').reshape(-1)
+
+    if interior_check:
+        outside = ~in_cardioid_or_bulb(c)
+        live, c, z = live[outside], c[outside], z[outside]
+
+    parked = np.zeros(c.shape, 'bool')
+
+    if periodicity_tolerance:
+        tolerance = periodicity_tolerance**2
+        saved = z.copy()
+        period = 1
+        check_at = start
+
+    for i in xrange(start, iterations):
+        if not live.size:
+            break
+
+        z = ne.evaluate('z**2+c')
+        escaped = ne.evaluate('real(z)**2 + imag(z)**2 > 4')
+        done = escaped
+
+        if periodicity_tolerance:
+            cycled = ne.evaluate('((real(z)-real(saved))**2 + (imag(z)-imag(saved))**2 < tolerance) & ~parked')
+            done = escaped | cycled
+
+            if i == check_at:
+                saved = z.copy()
+                period *= 2
+                check_at += period
+
+        if not done.any():
+            continue
+
+        escape_flat[live[escaped]] = i
+        parked |= done
+
+        if np.count_nonzero(parked) >= compact_fraction * live.size:
+            keep = ~parked
+            live, z, c, parked = live[keep], z[keep], c[keep], parked[keep]
+            if periodicity_tolerance:
+                saved = saved[keep]
+        else:
+            # Park the finished points where they can never escape again
+            z[done] = 0
+            c[done] = 0
+
+    if return_state:
+        keep = ~parked
+        return escape, live[keep], z[keep]
+    return escape
 
 
 class NumexprGenerator(Generator):
@@ -19,6 +117,86 @@ class NumexprGenerator(Generator):
 
     # Using:
     # http://www.vallis.org/salon/summary-10.html
+
+    # Only iterate the pixels that have not escaped yet, see compact_escape_time
+    compact = True
+    # Skip the cardioid and period-2 bulb, and retire cyclic orbits, when compacting
+    interior_check = True
+    # Of the pixel spacing, see PERIODICITY_TOLERANCE
+    periodicity_tolerance = PERIODICITY_TOLERANCE
+
+    def generate_tiles(self, tiles):
+        """
+        Stacks every tile into one tile count x tile_size x tile_size array and iterates them all together
+        """
+        if not self.compact or len(tiles) < 2:
+            return super(NumexprGenerator, self).generate_tiles(tiles)
+
+        tile_size = self.tile_size
+        log.debug("Generating {} tiles at once, {}px, i={}".format(len(tiles), tile_size, self.iterations))
+
+        c = np.empty((len(tiles), tile_size, tile_size), 'complex128')
+        for n, (x, y, z) in enumerate(tiles):
+            c[n] = self.region_points(*self.tile_region(x, y, z))
+
+        # The finest spacing of the batch holds for all of it
+        return list(self.escape_time(c, self.pixel_spacing(max(z for _, _, z in tiles))))
+
+    def pixel_spacing(self, z):
+        return ldexp(1., -z) / self.tile_size
+
+    def cycle_distance(self, spacing):
+        """
+        The distance at which an orbit counts as cyclic between pixels spacing apart
+        """
+        if self.periodicity_tolerance:
+            return self.periodicity_tolerance * spacing
+
+    def generate_tile_state(self, x, y, z, state=None):
+        """
+        Iterates the tile up to self.iterations, picking up from state when there is one
+        """
+        c = self.region_points(*self.tile_region(x, y, z)).reshape(-1)
+        tolerance = self.cycle_distance(self.pixel_spacing(z))
+
+        if state is None:
+            escape, live, orbits = compact_escape_time(c, self.iterations,
+                                                       interior_check=self.interior_check,
+                                                       periodicity_tolerance=tolerance,
+                                                       return_state=True)
+            return TileState(escape=escape.reshape((self.tile_size, self.tile_size)), live=live, z=orbits,
+                             iterations=self.iterations)
+
+        log.debug("Resuming tile {}, {}, {} from i={} with {} live pixels".format(
+            x, y, z, state.iterations, state.live.size))
+
+        live_escape, live, orbits = compact_escape_time(c[state.live], self.iterations,
+                                                        interior_check=False,
+                                                        periodicity_tolerance=tolerance,
+                                                        z=state.z, start=state.iterations, return_state=True)
+
+        escape = state.escape.copy()
+        escape[escape == state.iterations] = self.iterations
+        escape.reshape(-1)[state.live] = live_escape
+        return TileState(escape=escape, live=state.live[live], z=orbits, iterations=self.iterations)
+
+    def complete_tile(self, x, y, z, escape, known):
+        c = self.region_points(*self.tile_region(x, y, z))
+        unknown = ~known
+
+        escape = escape.copy()
+        escape[unknown] = self.escape_time(c[unknown], self.pixel_spacing(z))
+        return escape
+
+    def region_points(self, u0, u1, v0, v1):
+        xs, ys = np.meshgrid(*self.sample_axes(u0, u1, v0, v1))
+        return xs + 1j*ys
+
+    def escape_time(self, c, spacing):
+        return compact_escape_time(c, self.iterations,
+                                   interior_check=self.interior_check,
+                                   periodicity_tolerance=self.cycle_distance(spacing))
+
     def generate_region(self, u0, u1, v0, v1):
         """Compute an tile_size x tile_size Mandelbrot matrix with maxi maximum iterations."""
 
@@ -29,10 +207,12 @@ class NumexprGenerator(Generator):
                   Y {}->{}
                   {}px, i={}""".format(u0, u1, v0, v1, tile_size, iterations))
 
-        xs, ys = np.meshgrid(np.linspace(u0, u1, tile_size), np.linspace(v0, v1, tile_size))
+        c = self.region_points(u0, u1, v0, v1)
+
+        if self.compact:
+            return self.escape_time(c, abs(u1 - u0) / tile_size)
 
         z = np.zeros((tile_size, tile_size), 'complex128')
-        c = xs + 1j*ys
 
         escape = np.empty((tile_size, tile_size), 'int32')
         escape[:,:] = iterations
@@ -53,50 +233,151 @@ class NumexprGenerator(Generator):
         return escape
 
 
-class PerturbedGenerator(Generator):
+class MarianiSilverGenerator(Generator):
+    """
+    Recursively subdivides the tile, only computing the border of each rectangle
+
+    A rectangle whose whole border escapes at the same iteration is filled in without iterating its inside, which is
+    valid because the mandelbrot set is connected. Tiles covering the cardioid or the big bulbs mostly get filled.
+    """
+    # Rectangles with a side this short or shorter are computed outright instead of being split again
+    min_size = 8
+    # Of the pixel spacing, see PERIODICITY_TOLERANCE
+    periodicity_tolerance = PERIODICITY_TOLERANCE
 
     def generate_region(self, u0, u1, v0, v1):
         tile_size, iterations = self.tile_size, self.iterations
+
         log.debug("""Mandelbrot parameters:
                   X {}->{}
                   Y {}->{}
                   {}px, i={}""".format(u0, u1, v0, v1, tile_size, iterations))
 
-        dn = np.zeros((tile_size, tile_size), 'complex128')
+        xs, ys = np.meshgrid(*self.sample_axes(u0, u1, v0, v1))
+        c = xs + 1j*ys
+        tolerance = self.periodicity_tolerance * abs(u1 - u0) / tile_size
 
         escape = np.empty((tile_size, tile_size), 'int32')
-        escape[:,:] = iterations
+        known = np.zeros((tile_size, tile_size), 'bool')
 
-        # A number in the center of our viewport
-        xn = (u0 + u1) / 2 + 1j * ((v0 + v1) / 2)
-        x0 = xn
-        an = 0 + 0j
-        bn = 0 + 0j
-        cn = 0 + 0j
+        # Rectangles are (row0, row1, col0, col1), inclusive, neighbours share their borders
+        rects = [(0, tile_size-1, 0, tile_size-1)]
 
-        yi0, yj0 = np.meshgrid(np.linspace(u0, u1, tile_size), np.linspace(v0, v1, tile_size))
-        d0 = (yi0 + 1j*yj0) - x0
+        while rects:
+            # Every border of this level goes through the iterator in one pass
+            pending = np.zeros((tile_size, tile_size), 'bool')
+            for r0, r1, c0, c1 in rects:
+                pending[r0, c0:c1+1] = True
+                pending[r1, c0:c1+1] = True
+                pending[r0:r1+1, c0] = True
+                pending[r0:r1+1, c1] = True
+            self.compute(c, escape, known, pending, tolerance)
 
-        for i in xrange(1, iterations):
-            try:
-                cn = 2*xn*cn + 2*an*bn
-                bn = 2*xn*bn + an**2
-                an = 2*xn*an + 1
-                xn = xn**2 + x0
-            except OverflowError:
-                log.debug("I give up.")
-                break
+            pending[:, :] = False
+            subdivided = []
+            for r0, r1, c0, c1 in rects:
+                if r1 - r0 < 2 or c1 - c0 < 2:
+                    # All border, nothing inside
+                    continue
 
-            # we're just wrapping the numpy expression with `evaluate`
-            mask = ne.evaluate('escape == iterations')
+                border = np.concatenate((escape[r0, c0:c1+1], escape[r1, c0:c1+1],
+                                         escape[r0+1:r1, c0], escape[r0+1:r1, c1]))
+                if (border == border[0]).all():
+                    escape[r0+1:r1, c0+1:c1] = border[0]
+                    known[r0+1:r1, c0+1:c1] = True
+                elif r1 - r0 <= self.min_size or c1 - c0 <= self.min_size:
+                    pending[r0+1:r1, c0+1:c1] = True
+                else:
+                    rm, cm = (r0 + r1) // 2, (c0 + c1) // 2
+                    subdivided.extend([(r0, rm, c0, cm), (r0, rm, cm, c1), (rm, r1, c0, cm), (rm, r1, cm, c1)])
 
-            # boolean indexing is not too numexpr-friendly, so instead we use
-            # the numpy function `where(cond,then,else)` and set z to 0
-            # at already-escaped points, to avoid overflows
-            dn = ne.evaluate('where(mask,an*d0 + bn*d0 + cn*d0,0)')
-
-            # again where; taking the real part of abs is necessary here
-            # because in numexpr abs(complex) is complex with 0 imaginary part
-            escape = ne.evaluate('where(mask & (abs(dn+xn).real > 2),i,escape)')
+            # The small rectangles that could not be filled
+            self.compute(c, escape, known, pending, tolerance)
+            rects = subdivided
 
         return escape
+
+    def compute(self, c, escape, known, pending, tolerance):
+        pending &= ~known
+        if pending.any():
+            escape[pending] = compact_escape_time(c[pending], self.iterations, periodicity_tolerance=tolerance)
+            known |= pending
+
+
+class PerturbedGenerator(Generator):
+    """
+    Deep zoom generator, iterates every pixel as a double precision offset from an exact reference orbit
+
+    See mandelbrot.perturbation. The first reference is a stored orbit near the tile, or one at the tile centre, pixels
+    that glitch get another reference picked among them, up to max_references per tile. Cost per tile stays about the
+    same however deep the zoom goes.
+    """
+    # Pixels closer than this fraction of the reference's magnitude are glitched
+    glitch_tolerance = 1e-3
+    # How small the cubic term of the series has to stay relative to the linear one for iterations to be skipped
+    series_tolerance = 1e-8
+    max_references = 8
+    # How many tile spans away a stored reference orbit may be and still get used
+    reference_reach = 2
+
+    def __init__(self, iterations, tile_size, reference_store=None):
+        super(PerturbedGenerator, self).__init__(iterations=iterations, tile_size=tile_size)
+        # Shared by every tile this generator makes, pass one in to share it between generators
+        self.reference_store = reference_store if reference_store is not None else ReferenceOrbitStore()
+
+    def generate_tile(self, x, y, z):
+        # The tile centre is exact, transform_index would round it to a double
+        scale = Fraction(2)**(z+1)
+        half_span = ldexp(1., -(z+1))
+        return self.generate_perturbed(Fraction(2*x + 1) / scale, Fraction(2*y - 1) / scale,
+                                       -half_span, half_span, half_span, -half_span)
+
+    def generate_region(self, u0, u1, v0, v1):
+        cu, cv = (Fraction(u0) + Fraction(u1)) / 2, (Fraction(v0) + Fraction(v1)) / 2
+        return self.generate_perturbed(cu, cv,
+                                       float(Fraction(u0) - cu), float(Fraction(u1) - cu),
+                                       float(Fraction(v0) - cv), float(Fraction(v1) - cv))
+
+    def generate_perturbed(self, cu, cv, du0, du1, dv0, dv1):
+        """
+        Computes the tile around the exact point cu + cv*i, with its edges at offsets du0, du1, dv0, dv1 from it
+        """
+        tile_size, iterations = self.tile_size, self.iterations
+        span = min(abs(du1 - du0), abs(dv1 - dv0))
+        precision = required_precision(span, tile_size)
+
+        log.debug("""Mandelbrot parameters:
+                  C {} + {}i
+                  X {}->{}
+                  Y {}->{}
+                  {}px, i={}, {} bits""".format(float(cu), float(cv), du0, du1, dv0, dv1,
+                                                tile_size, iterations, precision))
+
+        dus, dvs = np.meshgrid(*self.sample_axes(du0, du1, dv0, dv1))
+        d0 = (dus + 1j*dvs).reshape(-1)
+
+        escape = np.empty(d0.shape, 'int32')
+        pending = np.arange(d0.size)
+        reference = self.reference_store.get(cu, cv, precision, iterations, max_distance=self.reference_reach * span)
+        # Where the reference sits relative to the tile centre
+        offset = complex(reference.cu - cu, reference.cv - cv)
+
+        for passes_left in xrange(self.max_references - 1, -1, -1):
+            pending_escape, glitched, closeness = perturbed_escape_time(
+                reference, d0[pending] - offset, iterations,
+                series_tolerance=self.series_tolerance,
+                # The last reference has to do, nothing is left to fix its glitches
+                glitch_tolerance=self.glitch_tolerance if passes_left else 0)
+            escape[pending] = pending_escape
+
+            if not glitched.size:
+                break
+
+            # Rebase on the pixel deepest in the glitch, its offset is a double so the new centre stays exact
+            log.debug("{} glitched pixels, {} references left".format(glitched.size, passes_left))
+            pending = pending[glitched]
+            offset = d0[pending[np.argmin(closeness)]]
+            reference = self.reference_store.add(
+                ReferenceOrbit(cu + Fraction(offset.real), cv + Fraction(offset.imag), precision, iterations))
+
+        return escape.reshape((tile_size, tile_size))
@@ -3,6 +3,7 @@ The intent of this module is to make generating palettes easier. Dunno how that'
 """
 from __future__ import division
 import numpy as np
+from .compat import xrange
 import colorsys
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -31,3 +32,24 @@ def blue_black_orange_white(cycle_size):
         palette.append(color)
 
     return [(np.uint8(r*255), np.uint8(g*255), np.uint8(b*255)) for r, g, b in palette]
+
+
+def palette_lut(palette, max_color, iterations):
+    """
+    Compiles a palette into a lookup table of iterations + 1 uint8 colors
+
+    Escape count i gets palette[i % len(palette)], and iterations, the inside of the set, gets max_color. Channels
+    outside 0-255 wrap around the way np.uint8 always wrapped them.
+    """
+    colors = np.asarray(palette).astype('uint8').reshape((-1, 3))
+    lut = colors[np.arange(iterations + 1) % len(colors)]
+    lut[iterations] = max_color
+    return lut
+
+
+def colorize(lut, data, out=None):
+    """
+    Colors an escape count array into an (h, w, 3) uint8 array with a single lookup, into out if given
+    """
+    # clip keeps take from buffering when writing into out, counts past the end get max_color
+    return np.take(lut, data, axis=0, out=out, mode='clip')
@@ -0,0 +1,248 @@
+"""
+Perturbation theory for zooming past the precision of a double
+
+One reference orbit is computed exactly in fixed point python integers, every pixel then only iterates its tiny
+difference from the reference in double precision:
+    Z(n+1) = Z(n)**2 + C
+    d(n+1) = 2*Z(n)*d(n) + d(n)**2 + d0
+A cubic series in d0 skips the first iterations for every pixel at once, and pixels whose difference stops being
+small compared to the reference (glitches) are redone against a new reference picked among them.
+"""
+from __future__ import division
+from collections import OrderedDict
+from fractions import Fraction
+from math import frexp, ldexp
+import threading
+import numexpr as ne
+from .compat import xrange
+import numpy as np
+import logging
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+
+def to_fixed(value, precision):
+    # Floors value * 2**precision, value can be anything Fraction understands
+    value = Fraction(value)
+    return (value.numerator << precision) // value.denominator
+
+
+def from_fixed(value, precision):
+    # Only the top 60 bits make it into the double, shifting first keeps float() from overflowing
+    shift = max(value.bit_length() - 60, 0)
+    return ldexp(value >> shift, shift - precision)
+
+
+def required_precision(span, tile_size):
+    """
+    The bits a reference orbit needs to resolve pixels of a tile spanning span in the complex plane
+    """
+    return max(-frexp(span)[1], 0) + int(tile_size).bit_length() + 64
+
+
+class ReferenceOrbit(object):
+    """
+    The orbit of the point cu + cv*i computed to precision bits, stored as doubles
+
+    orbit[n] is Z(n), starting at Z(0) = 0, and stops after the first point that escapes or after iterations points.
+    """
+
+    def __init__(self, cu, cv, precision, iterations):
+        self.cu = Fraction(cu)
+        self.cv = Fraction(cv)
+        self.precision = precision
+        self.iterations = iterations
+
+        cr, ci = to_fixed(self.cu, precision), to_fixed(self.cv, precision)
+        four = 4 << (2 * precision)
+        xr = xi = 0
+
+        orbit = [0j]
+        for i in xrange(1, iterations):
+            xr, xi = ((xr*xr - xi*xi) >> precision) + cr, ((xr*xi) >> (precision - 1)) + ci
+            orbit.append(complex(from_fixed(xr, precision), from_fixed(xi, precision)))
+            if xr*xr + xi*xi > four:
+                break
+
+        self.orbit = np.array(orbit, 'complex128')
+        self.series_cache = {}
+
+    def __len__(self):
+        return len(self.orbit)
+
+    @property
+    def nbytes(self):
+        return self.orbit.nbytes
+
+    def covers(self, precision, iterations):
+        """
+        Whether this orbit can stand in for one computed to precision bits over iterations
+        """
+        return self.precision >= precision and (self.iterations >= iterations or len(self.orbit) < self.iterations)
+
+    def series(self, radius, tolerance):
+        """
+        Memoized find_series, every tile at a zoom level asks with the same radius
+        """
+        key = (radius, tolerance)
+        if key not in self.series_cache:
+            if len(self.series_cache) >= 16:
+                self.series_cache.clear()
+            self.series_cache[key] = self.find_series(radius, tolerance)
+        return self.series_cache[key]
+
+    def find_series(self, radius, tolerance):
+        """
+        Finds how many iterations the cubic series can skip for offsets up to radius from the reference
+
+        The coefficients are scaled by powers of radius, so d(n) = a*u + b*u**2 + c*u**3 with u = d0/radius, which
+        keeps them representable at any zoom.
+        :return: (n, a, b, c), n = 0 when nothing can be skipped
+        """
+        orbit = self.orbit
+        a = b = c = 0j
+        skipped = (0, a, b, c)
+
+        for n in xrange(len(orbit) - 1):
+            zn = orbit[n]
+            a, b, c = 2*zn*a + radius, 2*zn*b + a*a, 2*zn*c + 2*a*b
+
+            # Stop once the cubic term matters or anything could have escaped
+            if abs(c) > tolerance * abs(a) or abs(orbit[n+1]) + abs(a) + abs(b) + abs(c) >= 2:
+                break
+
+            skipped = (n + 1, a, b, c)
+
+        return skipped
+
+
+class ReferenceOrbitStore(object):
+    """
+    Keeps reference orbits so the tiles of a frame, and the frames after it, can share them
+
+    Orbits are looked up by distance from the point a tile wants, the least recently used go once the orbits take
+    more than max_bytes. Safe to share between threads, an orbit is computed outside the lock so two threads may both
+    compute the same one, the second keeps the first's.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        self.max_bytes = max_bytes
+        self.orbits = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks do not pickle, workers started by spawn get a copy of the store
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, cu, cv, precision, iterations, max_distance):
+        """
+        Finds a stored orbit within max_distance of cu + cv*i that is precise and long enough, or computes one at
+        cu + cv*i
+        """
+        with self.lock:
+            for key, reference in self.orbits.items():
+                if reference.covers(precision, iterations) \
+                        and abs(reference.cu - cu) <= max_distance and abs(reference.cv - cv) <= max_distance:
+                    # Most recently used goes last
+                    del self.orbits[key]
+                    self.orbits[key] = reference
+                    return reference
+
+        return self.add(ReferenceOrbit(cu, cv, precision, iterations))
+
+    def add(self, reference):
+        key = (reference.cu, reference.cv, reference.precision, reference.iterations)
+        with self.lock:
+            if key in self.orbits:
+                return self.orbits[key]
+
+            self.orbits[key] = reference
+            self.nbytes += reference.nbytes
+
+            while self.nbytes > self.max_bytes and len(self.orbits) > 1:
+                _, evicted = self.orbits.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+        return reference
+
+
+def perturbed_escape_time(reference, d0, iterations, series_tolerance, glitch_tolerance):
+    """
+    Iterates every offset d0 (doubles, relative to reference) against the reference orbit
+
+    :return: (escape, glitched, closeness)
+        escape: int32 escape counts shaped like d0
+        glitched: flat indices of the points that glitched or outlived the reference, their escape is meaningless
+        closeness: |z|/|Z| of every glitched point when it was caught, the smallest marks the heart of the glitch
+    Passing glitch_tolerance=0 turns glitch detection off, points that outlive the reference are then finished
+    without it.
+    """
+    escape = np.empty(d0.shape, 'int32')
+    escape[...] = iterations
+    escape_flat = escape.reshape(-1)
+
+    orbit = reference.orbit
+    d0 = np.array(d0, 'complex128').reshape(-1)
+    live = np.arange(d0.size)
+
+    radius = float(np.abs(d0).max()) if d0.size else 0.
+    start, a, b, c = reference.series(radius, series_tolerance) if radius else (0, 0j, 0j, 0j)
+    if radius:
+        u = d0 / radius
+        d = ne.evaluate('a*u + b*u**2 + c*u**3')
+    else:
+        d = np.zeros_like(d0)
+    log.debug("Series skipped {} of {} iterations".format(start, iterations))
+
+    glitch_tolerance = glitch_tolerance**2
+    glitched = []
+    closeness = []
+
+    for n in xrange(start, iterations - 1):
+        if not live.size:
+            break
+
+        if n + 1 >= len(orbit):
+            z = orbit[n] + d
+            if glitch_tolerance:
+                # The reference escaped before these points did, the one nearest the origin makes the best next one
+                glitched.append(live)
+                closeness.append(np.abs(z))
+            else:
+                # Nothing is left to rebase on, finish them off in plain double precision
+                from .generators import compact_escape_time
+                c = complex(reference.cu, reference.cv) + d0
+                escape_flat[live] = compact_escape_time(c, iterations, start=n+1, z=z,
+                                                        interior_check=False, periodicity_tolerance=None)
+            break
+
+        zn, zn1 = orbit[n], orbit[n+1]
+        reference_size = (zn1 * zn1.conjugate()).real
+        d = ne.evaluate('2*zn*d + d**2 + d0')
+        size = ne.evaluate('real(zn1+d)**2 + imag(zn1+d)**2')
+
+        escaped = size > 4
+        wrong = (size < glitch_tolerance * reference_size) & ~escaped
+        done = escaped | wrong
+
+        if not done.any():
+            continue
+
+        escape_flat[live[escaped]] = n + 1
+        if wrong.any():
+            glitched.append(live[wrong])
+            closeness.append(np.sqrt(size[wrong] / reference_size))
+
+        keep = ~done
+        live, d, d0 = live[keep], d[keep], d0[keep]
+
+    if glitched:
+        return escape, np.concatenate(glitched), np.concatenate(closeness)
+    return escape, np.empty(0, 'intp'), np.empty(0)
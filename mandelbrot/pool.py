@@ -0,0 +1,171 @@
+"""
+Generates tiles in worker processes
+
+Every worker writes its tiles into slots of one shared memory block, so only the slot number is pickled on the way back
+and the parent copies the tile out of the slot.
+"""
+import ctypes
+import multiprocessing
+import threading
+import numpy as np
+from .compat import xrange, Queue
+import logging
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+# Set in each worker by init_worker
+worker_generator = None
+worker_slots = None
+
+
+def slot_view(raw, tile_size):
+    return np.frombuffer(raw, 'int32').reshape((-1, tile_size, tile_size))
+
+
+def init_worker(generator, raw):
+    global worker_generator, worker_slots
+    worker_generator = generator
+    worker_slots = slot_view(raw, generator.tile_size)
+
+
+def generate_into_slots(slots, tiles):
+    # Exceptions are handed back rather than raised, a task that raises never reaches its callback
+    try:
+        for slot, data in zip(slots, worker_generator.generate_tiles(tiles)):
+            worker_slots[slot] = data
+    except Exception as e:
+        log.exception("Generating tiles {} failed".format(tiles))
+        return slots, e
+    return slots, None
+
+
+class TilePool(object):
+    """
+    A pool of worker processes generating tiles with copies of generator, up to batch_size tiles per task
+
+    Slots belong to the pool rather than to a call of generate_tiles, a slot is only handed back once its task is done
+    and its tile copied out, so neither calls from several threads nor a call given up early share a slot with a task
+    still writing into it.
+
+    A worker that dies, killed for memory or crashed in native code, takes its task with it and no callback ever
+    comes. The waits check the workers every poll_seconds, and once one has died the pool is terminated and every call
+    raises.
+    """
+    poll_seconds = 1
+
+    def __init__(self, generator, workers, batch_size=1):
+        tile_size = generator.tile_size
+        self.workers = workers
+        self.batch_size = batch_size
+        # Two batches per worker keeps every worker busy while the parent copies results out
+        self.slot_count = 2 * workers * batch_size
+        self.raw = multiprocessing.RawArray(ctypes.c_int32, self.slot_count * tile_size * tile_size)
+        self.slots = slot_view(self.raw, tile_size)
+        self.free = list(range(self.slot_count))
+        self.slots_freed = threading.Condition()
+        # Why the pool is broken, None while it works
+        self.broken = None
+        self.pool = multiprocessing.Pool(workers, init_worker, (generator, self.raw))
+        self.worker_pids = self.current_pids()
+
+    def current_pids(self):
+        return set(process.pid for process in self.pool._pool)
+
+    def workers_died(self):
+        # Pool quietly replaces dead workers, a changed pid is one that died and was replaced
+        return any(process.exitcode is not None for process in self.pool._pool) \
+            or self.current_pids() != self.worker_pids
+
+    def check_workers(self):
+        """
+        Raises once the pool is broken, breaking it if a worker died
+        """
+        if self.broken is None and self.workers_died():
+            self.break_pool("A tile worker died, its tiles will never come back")
+        if self.broken is not None:
+            raise RuntimeError(self.broken)
+
+    def break_pool(self, reason):
+        log.error(reason)
+        with self.slots_freed:
+            self.broken = reason
+            # Callers waiting for slots would wait forever
+            self.slots_freed.notify_all()
+        self.pool.terminate()
+
+    def take_slots(self, count, wait):
+        """
+        count free slots, None if there are not that many and wait is false
+        """
+        with self.slots_freed:
+            while wait and len(self.free) < count and self.broken is None:
+                self.slots_freed.wait()
+            if self.broken is not None:
+                raise RuntimeError(self.broken)
+            if len(self.free) >= count:
+                return tuple(self.free.pop() for _ in xrange(count))
+
+    def give_slots(self, slots):
+        with self.slots_freed:
+            self.free.extend(slots)
+            self.slots_freed.notify_all()
+
+    def generate_tiles(self, tiles):
+        """
+        Yields (tile, data) for every tile, in the order the workers finish them
+        """
+        # Small requests are spread over every worker rather than packed into full batches
+        batch_size = max(1, min(self.batch_size, -(-len(tiles) // self.workers)))
+        # Last batch first, submit pops them off the end
+        batches = [tiles[start:start + batch_size] for start in xrange(0, len(tiles), batch_size)][::-1]
+        pending = {}
+        finished = Queue.Queue()
+
+        def submit():
+            while batches:
+                # Waits for slots only with nothing in flight, otherwise the next finished task frees some
+                slots = self.take_slots(len(batches[-1]), wait=not pending)
+                if slots is None:
+                    break
+                batch = batches.pop()
+                pending[slots] = batch
+                # Errors generate_into_slots cannot hand back, like a result that does not pickle, come through
+                # error_callback
+                self.pool.apply_async(generate_into_slots, (slots, [(t.x, t.y, t.z) for t in batch]),
+                                      callback=finished.put,
+                                      error_callback=lambda error, slots=slots: finished.put((slots, error)))
+
+        self.check_workers()
+        try:
+            submit()
+            while pending:
+                try:
+                    slots, error = finished.get(timeout=self.poll_seconds)
+                except Queue.Empty:
+                    self.check_workers()
+                    continue
+                batch = pending.pop(slots)
+                try:
+                    if error is not None:
+                        raise error
+                    for slot, tile in zip(slots, batch):
+                        yield tile, self.slots[slot].copy()
+                finally:
+                    self.give_slots(slots)
+                submit()
+        finally:
+            # Raised or dropped early, tasks still running keep writing into their slots until they are done, a
+            # broken pool has been terminated and its tasks never will be
+            while pending and self.broken is None:
+                try:
+                    slots, _ = finished.get(timeout=self.poll_seconds)
+                except Queue.Empty:
+                    if self.workers_died():
+                        self.break_pool("A tile worker died, its tiles will never come back")
+                    continue
+                pending.pop(slots)
+                self.give_slots(slots)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
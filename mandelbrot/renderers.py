@@ -1,6 +1,8 @@
 from PIL import Image
 import numpy as np
 from .base import Renderer
+from .palettes import palette_lut, colorize
+from .util import LRUCache, uniform_value
 import numpy as np
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -8,28 +10,67 @@ log = logging.getLogger(__name__)
 
 
 class NumpyColorRenderer(Renderer):
-    def color_data(self, generator, data):
-        palette = self.palette
-        iterations = generator.iterations
-        max_color = self.max_color
-
-        palette_length = len(palette)
-
-        @np.vectorize
-        def colorize_matrix(i):
-            if i == iterations:
-                return max_color
-            else:
-                return palette[i % palette_length]
-
-        colorized_data = colorize_matrix(data)
-        # starts as a 3 tuple of dpuxdpu integers
-        colorized_data = np.uint8(np.array(colorized_data))
-        # Turns it into an array of uint8s
-        colorized_data = np.rollaxis(colorized_data, axis=0, start=3)
-        # Starts (3, 400, 400), rollaxis moves the color to the last place (400, 400, 3)
-
-        return colorized_data
+    lut = None
+    # Colored tiles are kept at full, half and quarter size
+    mip_levels = 3
+    mip_cache_bytes = 128 << 20
+    mips = None
+
+    def palette_lut(self, generator):
+        # Compiled again whenever the iteration count changes
+        if self.lut is None or len(self.lut) != generator.iterations + 1:
+            self.lut = palette_lut(self.palette, self.max_color, generator.iterations)
+        return self.lut
+
+    def color_value(self, generator, value):
+        return tuple(int(channel) for channel in self.palette_lut(generator)[value])
+
+    def color_data(self, generator, data, out=None):
+        """
+        Colors escape counts into an (h, w, 3) uint8 array, writing into out when given
+        """
+        return colorize(self.palette_lut(generator), data, out=out)
+
+    def mip_chain(self, tile, data, size):
+        """
+        The colored tile followed by copies of half the size of the one before, remembered per tile
+
+        Levels are only made once a render wants them, down to the smallest one at least size pixels across.
+        """
+        if self.mips is None:
+            self.mips = LRUCache(self.mip_cache_bytes, sizeof=lambda chain: sum(level.nbytes for level in chain))
+
+        key = self.tile_manager.get_tile_key(tile)
+        chain = self.mips.get(key)
+        grown = chain is None
+        if grown:
+            chain = (self.color_data(self.tile_manager.generator, data),)
+            chain[0].flags.writeable = False
+
+        while len(chain) < self.mip_levels and chain[-1].shape[0] // 2 >= size \
+                and not chain[-1].shape[0] % 2 and not chain[-1].shape[1] % 2:
+            h, w, _ = chain[-1].shape
+            # Each pixel is the rounded mean of the 2x2 block below it
+            level = chain[-1].reshape((h // 2, 2, w // 2, 2, 3)).sum(axis=(1, 3), dtype='uint16')
+            level = ((level + 2) // 4).astype('uint8')
+            level.flags.writeable = False
+            chain += (level,)
+            grown = True
+
+        # A new tuple rather than a grown list, so the cache sizes it again
+        if grown:
+            self.mips.put(key, chain)
+        return chain
+
+    def mip_level(self, tile, data, size):
+        """
+        The smallest level of the tile's mip chain at least size pixels across
+        """
+        chain = self.mip_chain(tile, data, size)
+        for level in reversed(chain):
+            if level.shape[0] >= size:
+                return level
+        return chain[0]
 
 from PIL import ImageDraw
 
@@ -66,11 +107,95 @@ class PILRenderer(NumpyColorRenderer):
     def render_renderset(self, renderset):
         apparent_tile_size = renderset.apparent_tile_size
         img = Image.new('RGB', (self.w, self.h), self.max_color)
-        for tile in renderset.data_tiles:
+        for tile, data in self.tile_manager.get_tiles_data(renderset.data_tiles):
+            value = uniform_value(data)
+            if value is not None:
+                # Nothing to color or resample, just fill the tile's box
+                img.paste(self.color_value(self.tile_manager.generator, value),
+                          box=(tile.pix_x, tile.pix_y, tile.pix_x + apparent_tile_size, tile.pix_y + apparent_tile_size))
+                continue
+
             img.paste(
-                im=Image.fromarray(self.color_data(self.tile_manager.generator, self.tile_manager.get_tile_data(tile)), 'RGB').resize(
+                im=Image.fromarray(self.mip_level(tile, data, apparent_tile_size), 'RGB').resize(
                     size=(apparent_tile_size, apparent_tile_size),
                     resample=self.resample_method),
                 box=(tile.pix_x, tile.pix_y)
             )
         return np.asarray(self.add_debug_info(renderset, img))
+
+
+class NumpyRenderer(NumpyColorRenderer):
+    """
+    Resamples colored tiles straight into one frame array with separable bilinear weights, no PIL involved
+
+    The frame is reused between calls, copy it to keep a frame past the next render.
+    """
+
+    def __init__(self, size, palette, max_color, tile_manager):
+        super(NumpyRenderer, self).__init__(size, palette, max_color, tile_manager)
+        self.frame = np.empty((self.h, self.w, 3), 'uint8')
+        self.axis_weights = {}
+
+    def resample_axis(self, tile_size, apparent_tile_size):
+        """
+        For every pixel across a tile_size tile drawn apparent_tile_size wide: the two source pixels around its center
+        and the weight of the second, cached per pair of sizes
+        """
+        if (tile_size, apparent_tile_size) not in self.axis_weights:
+            centers = (np.arange(apparent_tile_size) + 0.5) * (tile_size / apparent_tile_size) - 0.5
+            centers = np.clip(centers, 0, tile_size - 1)
+            low = np.floor(centers).astype('intp')
+            high = np.minimum(low + 1, tile_size - 1)
+            weight = (centers - low).astype('float32')
+            self.axis_weights[tile_size, apparent_tile_size] = low, high, weight
+        return self.axis_weights[tile_size, apparent_tile_size]
+
+    def layout(self, renderset):
+        """
+        The frame box of every tile clipped to the frame, with the span of the tile each box shows
+        :return: [(tile, (top, bottom, left, right), (row_start, row_stop, col_start, col_stop))]
+        """
+        size = renderset.apparent_tile_size
+        boxes = []
+        for tile in renderset.data_tiles:
+            top, left = max(tile.pix_y, 0), max(tile.pix_x, 0)
+            bottom, right = min(tile.pix_y + size, self.h), min(tile.pix_x + size, self.w)
+            if top < bottom and left < right:
+                boxes.append((tile, (top, bottom, left, right),
+                              (top - tile.pix_y, bottom - tile.pix_y, left - tile.pix_x, right - tile.pix_x)))
+        return boxes
+
+    def render_renderset(self, renderset):
+        generator = self.tile_manager.generator
+        apparent_tile_size = renderset.apparent_tile_size
+        boxes = dict((tile, (box, span)) for tile, box, span in self.layout(renderset))
+
+        frame = self.frame
+        frame[...] = self.max_color
+        for tile, data in self.tile_manager.get_tiles_data([tile for tile in renderset.data_tiles if tile in boxes]):
+            (top, bottom, left, right), (row_start, row_stop, col_start, col_stop) = boxes[tile]
+
+            value = uniform_value(data)
+            if value is not None:
+                frame[top:bottom, left:right] = self.color_value(generator, value)
+                continue
+
+            colored = self.mip_level(tile, data, apparent_tile_size)
+            rows = slice(row_start, row_stop)
+            cols = slice(col_start, col_stop)
+            if colored.shape[0] == apparent_tile_size:
+                frame[top:bottom, left:right] = colored[rows, cols]
+                continue
+
+            low, high, weight = self.resample_axis(colored.shape[0], apparent_tile_size)
+            row_weight = weight[rows, np.newaxis, np.newaxis]
+            col_weight = weight[cols, np.newaxis]
+            # Blend rows first, then columns of the blended rows, as a + (b - a)*weight
+            blended = colored[low[rows]].astype('float32')
+            blended += (colored[high[rows]] - blended) * row_weight
+            picked = blended[:, low[cols]]
+            picked += (blended[:, high[cols]] - picked) * col_weight
+            picked += 0.5
+            frame[top:bottom, left:right] = picked
+
+        return frame
@@ -0,0 +1,176 @@
+"""
+Fills a tile store ahead of a render or the tile server
+
+    python -m mandelbrot.seed --region -2 0.5 -1.25 1.25 --z 0 6 --backend sqlite --workers 4
+    python -m mandelbrot.seed --path -0.7483306070963540 0.1492396240234374 --size 1280 720 --z -3 15
+
+A region seeds every tile covering u0..u1, v0..v1 at each z. A path seeds the tiles a video zooming into u, v needs,
+the widest frame using each tile z. Coarse levels go first, tiles already stored are skipped, and progress is kept in
+a checkpoint after every chunk so an interrupted run carries on where it stopped.
+"""
+from __future__ import division, print_function
+from datetime import timedelta
+from fractions import Fraction
+from itertools import islice
+import argparse
+import json
+import os
+import time
+import logging
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+from .compat import xrange
+from .composer import Composer
+from .generators import NumexprGenerator, MarianiSilverGenerator, PerturbedGenerator
+from .util import DataTile
+
+GENERATORS = {
+    'numexpr': NumexprGenerator,
+    'mariani-silver': MarianiSilverGenerator,
+    'perturbed': PerturbedGenerator,
+}
+
+# Imported by name, so a backend's dependencies are only needed when it is picked
+BACKENDS = {
+    'numpy': 'NumpyCompressedTileManager',
+    'bounded': 'BoundedDiskTileManager',
+    'sqlite': 'SQLiteTileManager',
+    'memmap': 'MemmapTileManager',
+    'zodb': 'ZODBTileManager',
+}
+
+
+def region_tiles(u0, u1, v0, v1, z):
+    """
+    (tile count, the tiles at z covering u0..u1, v0..v1), tile x spans u from x to x+1 and tile y v from y-1 to y
+    """
+    scale = Fraction(2)**z
+    min_x, max_x = int((scale*Fraction(u0)) // 1), int((scale*Fraction(u1)) // 1)
+    min_y, max_y = -int((-scale*Fraction(v0)) // 1), -int((-scale*Fraction(v1)) // 1)
+
+    count = (max_x - min_x + 1) * (max_y - min_y + 1)
+    return count, (DataTile(x=x, y=y, z=z, pix_x=0, pix_y=0)
+                   for y in xrange(max_y, min_y - 1, -1) for x in xrange(min_x, max_x + 1))
+
+
+def path_tiles(u, v, z, size, tile_size):
+    """
+    (tile count, the tiles at z a frame of size centered on u, v needs at any zoom using them)
+    """
+    # Frames just past z-1 are the widest that still use tiles at z
+    tiles = Composer(size=size, tile_size=tile_size).generate_renderset(u, v, z - 1 + 1e-6).data_tiles
+    return len(tiles), (DataTile(x=tile.x, y=tile.y, z=tile.z, pix_x=0, pix_y=0) for tile in tiles)
+
+
+def seed_tiles(args):
+    """
+    (total, every tile to seed in order)
+    """
+    levels = []
+    for z in xrange(args.z[0], args.z[1] + 1):
+        if args.region:
+            levels.append(region_tiles(*(args.region + [z])))
+        else:
+            levels.append(path_tiles(args.path[0], args.path[1], z, args.size, args.tile_size))
+
+    def tiles():
+        for _, level in levels:
+            for tile in level:
+                yield tile
+
+    return sum(count for count, _ in levels), tiles()
+
+
+def load_checkpoint(filename, signature):
+    # How many tiles a previous run with the same arguments got through
+    if not os.path.exists(filename):
+        return 0
+    with open(filename) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint.get('signature') != signature:
+        log.warning("Checkpoint {} is for other arguments, starting over".format(filename))
+        return 0
+    return checkpoint['done']
+
+
+def save_checkpoint(filename, signature, done):
+    # Written aside and renamed over, an interrupted write never leaves half a checkpoint
+    with open(filename + '.tmp', 'w') as checkpoint_file:
+        json.dump({'signature': signature, 'done': done}, checkpoint_file)
+    os.rename(filename + '.tmp', filename)
+
+
+def seed(args):
+    from . import tile_managers
+
+    generator = GENERATORS[args.generator](iterations=args.iterations, tile_size=args.tile_size)
+    if args.aligned:
+        generator.aligned = True
+    tile_manager = getattr(tile_managers, BACKENDS[args.backend])(generator=generator, workers=args.workers)
+    tile_manager.reuse_pyramid = args.aligned
+
+    signature = dict((name, getattr(args, name)) for name in
+                     ('region', 'path', 'size', 'z', 'tile_size', 'iterations', 'generator', 'backend', 'aligned'))
+    total, tiles = seed_tiles(args)
+    done = start = load_checkpoint(args.checkpoint, signature)
+    tiles = islice(tiles, start, None)
+    if start:
+        log.info("Resuming after {} of {} tiles".format(start, total))
+
+    made = 0
+    started = time.time()
+    try:
+        while True:
+            chunk = list(islice(tiles, args.chunk))
+            if not chunk:
+                break
+
+            missing = [tile for tile in chunk if not tile_manager.has_tile_data(tile)]
+            for _ in tile_manager.get_tiles_data(missing):
+                pass
+            # Backends that buffer writes commit them before the checkpoint says they are done
+            if hasattr(tile_manager, 'flush'):
+                tile_manager.flush()
+
+            # A tile and its mirror below the real axis are made once
+            made += len(set(tile_manager.canonical_tile(tile)[0][:3] for tile in missing))
+            done += len(chunk)
+            save_checkpoint(args.checkpoint, signature, done)
+
+            elapsed = time.time() - started
+            eta = timedelta(seconds=int(elapsed * (total - done) / (done - start)))
+            print("z {}: {}/{} tiles, {} made, {:.1f} tiles/s, ETA {}".format(
+                chunk[-1].z, done, total, made, made / elapsed if elapsed else 0, eta))
+    finally:
+        tile_manager.close()
+
+    # A finished run starts over next time, tiles may have been evicted since
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    print("Seeded {} tiles, made {} in {}".format(total, made, timedelta(seconds=int(time.time() - started))))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates and stores every tile of a region or zoom path ahead of time")
+    area = parser.add_mutually_exclusive_group(required=True)
+    area.add_argument('--region', nargs=4, metavar=('U0', 'U1', 'V0', 'V1'),
+                      help="every tile covering this part of the plane, decimal strings keep their digits")
+    area.add_argument('--path', nargs=2, metavar=('U', 'V'), help="the tiles a zoom into U, V needs")
+    parser.add_argument('--size', nargs=2, type=int, default=[1280, 720], metavar=('W', 'H'),
+                        help="frame size of the zoom path")
+    parser.add_argument('--z', nargs=2, type=int, required=True, metavar=('Z0', 'Z1'), help="tile z range, inclusive")
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--iterations', type=int, default=100)
+    parser.add_argument('--generator', choices=sorted(GENERATORS), default='numexpr')
+    parser.add_argument('--aligned', action='store_true', help="aligned sampling, builds tiles out of stored levels")
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='numpy')
+    parser.add_argument('--workers', type=int, default=None, help="worker processes, none generates in this one")
+    parser.add_argument('--chunk', type=int, default=64, help="tiles between checkpoints")
+    parser.add_argument('--checkpoint', default='seed-checkpoint.json')
+    seed(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Serves tiles over HTTP the way slippy maps ask for them, Python 3 only
+
+    GET /{z}/{x}/{y}.png  the tile colored by a NumpyColorRenderer
+    GET /{z}/{x}/{y}.raw  the escape counts as little endian unsigned integers, X-Tile-Dtype and X-Tile-Shape say which
+
+Slippy map rows count down from the top where tile rows here count up, so y is served as tile y = -y.
+Tiles are generated in an executor so the event loop keeps answering. A tile never changes for its key, so the ETag is
+taken from get_tile_key and a matching If-None-Match is answered with 304 before anything is loaded. Bodies are kept
+in an LRUCache, raw bodies together with their gzipped copy.
+
+    python -m mandelbrot.server --port 8080
+    curl -s -D - -o tile.png http://localhost:8080/2/-3/1.png
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import re
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from PIL import Image
+import numpy as np
+import logging
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+from .tile_codecs import escape_dtype
+from .util import DataTile, LRUCache
+
+TILE_PATH = re.compile(r'^/(-?\d+)/(-?\d+)/(-?\d+)\.(png|raw)$')
+CONTENT_TYPES = {'png': 'image/png', 'raw': 'application/octet-stream'}
+REASONS = {200: 'OK', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           500: 'Internal Server Error'}
+
+
+class TileServer(object):
+    """
+    Answers tile requests out of tile_manager, coloring them with renderer
+
+    :param executor: runs the tile generation, a thread pool of workers threads by default, the tile manager has to
+        be usable from its threads
+    """
+    workers = 4
+    max_bytes = 64 << 20
+    # PNGs are already deflated, gzipping them again only costs time
+    gzip_formats = ('raw',)
+
+    def __init__(self, tile_manager, renderer, executor=None, max_bytes=None):
+        self.tile_manager = tile_manager
+        self.renderer = renderer
+        self.executor = executor or ThreadPoolExecutor(self.workers)
+        self.bodies = LRUCache(max_bytes or self.max_bytes,
+                               sizeof=lambda bodies: sum(len(body) for body in bodies if body))
+        # Requests for a tile that is being made wait on the same future
+        self.making = {}
+
+        generator = tile_manager.generator
+        # Colored tiles change with the palette, raw ones with their dtype
+        palette = hashlib.md5(renderer.palette_lut(generator).tobytes()).hexdigest()
+        self.variants = {'png': palette, 'raw': escape_dtype(generator.iterations).name}
+
+    def etag(self, tile, fmt):
+        key = '{}.{}.{}'.format(self.tile_manager.get_tile_key(tile), fmt, self.variants[fmt])
+        return '"{}"'.format(hashlib.md5(key.encode('ascii')).hexdigest())
+
+    def make_bodies(self, tile, fmt):
+        """
+        Blocking, returns (body, gzipped body or None)
+        """
+        generator = self.tile_manager.generator
+        data = self.tile_manager.get_tile_data(tile)
+
+        if fmt == 'png':
+            buf = BytesIO()
+            Image.fromarray(self.renderer.color_data(generator, data), 'RGB').save(buf, 'PNG')
+            body = buf.getvalue()
+        else:
+            body = np.ascontiguousarray(data, escape_dtype(generator.iterations).newbyteorder('<')).tobytes()
+
+        return body, gzip.compress(body) if fmt in self.gzip_formats else None
+
+    async def bodies_for(self, tile, fmt, etag):
+        bodies = self.bodies.get(etag)
+        if bodies is not None:
+            return bodies
+
+        making = self.making.get(etag)
+        if making is None:
+            making = self.making[etag] = asyncio.get_running_loop().run_in_executor(
+                self.executor, self.make_bodies, tile, fmt)
+        try:
+            bodies = await asyncio.shield(making)
+        finally:
+            if self.making.get(etag) is making:
+                del self.making[etag]
+
+        self.bodies.put(etag, bodies)
+        return bodies
+
+    async def respond(self, method, target, headers):
+        """
+        :return: (status, headers, body)
+        """
+        if method not in ('GET', 'HEAD'):
+            return 405, {'Allow': 'GET, HEAD'}, b''
+
+        match = TILE_PATH.match(target.split('?', 1)[0])
+        if not match:
+            return 404, {}, b''
+
+        z, x, y = (int(group) for group in match.groups()[:3])
+        fmt = match.group(4)
+        tile = DataTile(x=x, y=-y, z=z, pix_x=0, pix_y=0)
+
+        etag = self.etag(tile, fmt)
+        response_headers = {
+            'ETag': etag,
+            'Cache-Control': 'public, max-age=31536000, immutable',
+            'Access-Control-Allow-Origin': '*',
+        }
+        if fmt in self.gzip_formats:
+            response_headers['Vary'] = 'Accept-Encoding'
+
+        if_none_match = headers.get('if-none-match', '')
+        if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return 304, response_headers, b''
+
+        body, gzipped = await self.bodies_for(tile, fmt, etag)
+
+        response_headers['Content-Type'] = CONTENT_TYPES[fmt]
+        if fmt == 'raw':
+            tile_size = self.tile_manager.generator.tile_size
+            response_headers['X-Tile-Dtype'] = escape_dtype(self.tile_manager.generator.iterations).name
+            response_headers['X-Tile-Shape'] = '{},{}'.format(tile_size, tile_size)
+        if gzipped is not None and 'gzip' in headers.get('accept-encoding', ''):
+            response_headers['Content-Encoding'] = 'gzip'
+            body = gzipped
+
+        return 200, response_headers, body
+
+    async def handle(self, reader, writer):
+        """
+        Answers requests on one connection until the client closes it or asks to
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    await self.write_response(writer, 'HTTP/1.1', 400, {'Connection': 'close'}, b'', 'GET')
+                    break
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                try:
+                    status, response_headers, body = await self.respond(method, target, headers)
+                except Exception:
+                    log.exception("Serving {} failed".format(target))
+                    status, response_headers, body = 500, {}, b''
+
+                if not keep_alive:
+                    response_headers['Connection'] = 'close'
+                await self.write_response(writer, version, status, response_headers, body, method)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def write_response(writer, version, status, headers, body, method):
+        headers['Content-Length'] = str(len(body))
+        head = '{} {} {}\r\n'.format(version, status, REASONS[status])
+        head += ''.join('{}: {}\r\n'.format(name, value) for name, value in headers.items())
+        writer.write(head.encode('latin-1') + b'\r\n')
+        if method != 'HEAD' and status != 304:
+            writer.write(body)
+        await writer.drain()
+
+    async def start(self, host='127.0.0.1', port=8080):
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        """
+        Answers requests until cancelled
+        """
+        listening = await self.start(host, port)
+        log.info("Serving tiles on {}:{}".format(host, port))
+        async with listening:
+            await listening.serve_forever()
+
+
+def main():
+    from .generators import NumexprGenerator
+    from .palettes import blue_black_orange_white
+    from .renderers import NumpyColorRenderer
+    from .tile_managers import MemoryCachedTileManager, SQLiteTileManager
+
+    parser = argparse.ArgumentParser(description="Serves mandelbrot tiles at /{z}/{x}/{y}.png and .raw")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--tile-size', type=int, default=256)
+    parser.add_argument('--iterations', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=TileServer.workers)
+    args = parser.parse_args()
+
+    tile_manager = MemoryCachedTileManager(
+        generator=NumexprGenerator(iterations=args.iterations, tile_size=args.tile_size),
+        backend=SQLiteTileManager)
+    renderer = NumpyColorRenderer(size=(args.tile_size, args.tile_size), palette=blue_black_orange_white(cycle_size=30),
+                                  max_color=(0, 0, 0), tile_manager=tile_manager)
+    server = TileServer(tile_manager, renderer, executor=ThreadPoolExecutor(args.workers))
+
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        tile_manager.close()
+
+
+if __name__ == '__main__':
+    main()
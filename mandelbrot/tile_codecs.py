@@ -0,0 +1,119 @@
+"""
+Packs tiles into bytes and back
+
+Escape counts are stored in the narrowest unsigned type that holds the iteration count and filtered before compression:
+    delta: each row as differences from the pixel to its left
+    shuffle: all the low bytes, then all the high bytes, the high bytes are mostly zero
+Tiles whose pixels all match are stored as just that value, and decode to a uniform_tile.
+tile-codec-benchmark.py compares the settings. Escape counts come in long runs that the compressors already handle,
+delta breaks them up and makes tiles bigger, shuffle saves another tenth at twice the decode time, so both are off by
+default.
+"""
+import bz2
+import struct
+import zlib
+import numpy as np
+from .util import uniform_tile, uniform_value
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+def escape_dtype(iterations):
+    """
+    The narrowest unsigned integer type that holds every escape count up to iterations
+    """
+    for dtype in ('uint8', 'uint16', 'uint32'):
+        if iterations <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype('uint64')
+
+
+def identity(data):
+    return data
+
+
+# Stored in the header by position, only ever append
+COMPRESSORS = [
+    ('none', identity, identity),
+    ('zlib', zlib.compress, zlib.decompress),
+    ('bz2', bz2.compress, bz2.decompress),
+]
+if lzma is not None:
+    COMPRESSORS.append(('lzma', lzma.compress, lzma.decompress))
+
+DTYPES = ['uint8', 'uint16', 'uint32', 'uint64']
+
+
+class TileCodec(object):
+    """
+    Encodes escape count tiles as a small header followed by the filtered, compressed pixels
+
+    :param compressor: one of the names in COMPRESSORS
+    :param delta: store every row as differences between neighbouring pixels
+    :param shuffle: store the pixels one byte plane at a time
+    """
+    magic = b'MTIL'
+    # magic, version, dtype, filters, compressor, height, width
+    header = struct.Struct('<4sBBBBII')
+    version = 1
+    DELTA = 1
+    SHUFFLE = 2
+    # Every pixel is the single value that follows the header
+    UNIFORM = 4
+
+    def __init__(self, compressor='zlib', delta=False, shuffle=False):
+        names = [name for name, _, _ in COMPRESSORS]
+        if compressor not in names:
+            raise ValueError("Unknown compressor {}, pick one of {}".format(compressor, ', '.join(names)))
+
+        self.compressor = names.index(compressor)
+        self.filters = (self.DELTA if delta else 0) | (self.SHUFFLE if shuffle else 0)
+
+    def encode(self, data, iterations):
+        dtype = escape_dtype(iterations)
+        height, width = data.shape
+
+        value = uniform_value(data)
+        if value is None and (data == data.flat[0]).all():
+            value = data.flat[0]
+        if value is not None:
+            return self.header.pack(self.magic, self.version, DTYPES.index(dtype.name), self.UNIFORM, 0,
+                                    height, width) + np.array(value, dtype).tobytes()
+
+        pixels = np.ascontiguousarray(data, dtype)
+
+        if self.filters & self.DELTA:
+            # Unsigned wraparound makes the differences exactly reversible
+            filtered = pixels.copy()
+            filtered[:, 1:] -= pixels[:, :-1]
+            pixels = filtered
+
+        if self.filters & self.SHUFFLE:
+            pixels = pixels.view('uint8').reshape((-1, dtype.itemsize)).T
+
+        _, compress, _ = COMPRESSORS[self.compressor]
+        return self.header.pack(self.magic, self.version, DTYPES.index(dtype.name), self.filters, self.compressor,
+                                height, width) + compress(np.ascontiguousarray(pixels).tobytes())
+
+    def decode(self, blob):
+        blob = bytes(blob)
+        magic, version, dtype, filters, compressor, height, width = self.header.unpack_from(blob)
+        if magic != self.magic or version != self.version:
+            raise ValueError("Not a version {} tile".format(self.version))
+
+        dtype = np.dtype(DTYPES[dtype])
+        if filters & self.UNIFORM:
+            return uniform_tile(np.frombuffer(blob[self.header.size:], dtype)[0], (height, width), dtype)
+
+        _, _, decompress = COMPRESSORS[compressor]
+        pixels = np.frombuffer(decompress(blob[self.header.size:]), 'uint8')
+
+        if filters & self.SHUFFLE:
+            pixels = np.ascontiguousarray(pixels.reshape((dtype.itemsize, -1)).T)
+        pixels = pixels.view(dtype).reshape((height, width))
+
+        if filters & self.DELTA:
+            return np.cumsum(pixels, axis=1, dtype=dtype)
+        return pixels.copy()
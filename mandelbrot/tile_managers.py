@@ -1,5 +1,9 @@
 from .base import TileManager
+from .tile_codecs import TileCodec, escape_dtype
+from .util import TileState, LRUCache, tile_nbytes, uniform_tile, uniform_value
 from os import path
+import os
+import threading
 import logging
 import numpy as np
 logging.basicConfig(level=logging.DEBUG)
@@ -7,55 +11,822 @@ log = logging.getLogger(__name__)
 
 
 class CachelessTileManager(TileManager):
-    def get_tile_data(self, tile):
-        return self.generate_tile_data(tile)
+    def load_tile_data(self, tile):
+        return None
+
+    def store_tile_data(self, tile, data):
+        pass
+
+    def load_tile_state(self, tile):
+        return None
+
+    def store_tile_state(self, tile, state):
+        pass
 
 
 class NumpyCompressedTileManager(TileManager):
     root = 'data/'
+    codec = TileCodec()
 
-    def get_tile_data(self, tile):
+    def load_tile_data(self, tile):
         log.debug("""Getting mandelbrot image
         x: {}, y: {}, z: {}""".format(tile.x, tile.y, tile.z))
-        filename = self.root + self.get_tile_key(tile) + '.npz'
+        filename = self.root + self.get_tile_key(tile)
+
+        # Missing files are misses, whether never stored or removed since by an evictor
+        try:
+            with open(filename + '.tile', 'rb') as tile_file:
+                return self.codec.decode(tile_file.read())
+        except (IOError, OSError):
+            pass
+
+        # Tiles stored before the codec
+        try:
+            return np.load(filename + '.npz')['mandel_data']
+        except (IOError, OSError):
+            return None
+
+    def tile_stored(self, tile):
+        filename = self.root + self.get_tile_key(tile)
+        return path.exists(filename + '.tile') or path.exists(filename + '.npz')
+
+    @staticmethod
+    def write_aside(filename, write):
+        """
+        Calls write with a temporary file next to filename, then renames it over filename so readers in other
+        processes see either the whole file or none of it
+        """
+        temp = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.current_thread().ident)
+        try:
+            with open(temp, 'wb') as temp_file:
+                write(temp_file)
+            os.rename(temp, filename)
+        except Exception:
+            if path.exists(temp):
+                os.remove(temp)
+            raise
+
+    def store_tile_data(self, tile, data):
+        blob = self.codec.encode(data, self.generator.iterations)
+        self.write_aside(self.root + self.get_tile_key(tile) + '.tile', lambda tile_file: tile_file.write(blob))
+
+    def load_tile_state(self, tile):
+        try:
+            stored = np.load(self.root + self.get_state_key(tile) + '.npz')
+            return TileState(escape=stored['escape'], live=stored['live'], z=stored['z'],
+                             iterations=int(stored['iterations']))
+        except (IOError, OSError):
+            return None
+
+    def store_tile_state(self, tile, state):
+        self.write_aside(self.root + self.get_state_key(tile) + '.npz',
+                         lambda state_file: np.savez_compressed(state_file, **state._asdict()))
+
+
+class MemoryCachedTileManager(TileManager):
+    """
+    Keeps the most recently used tiles of another tile manager in memory, up to max_bytes
+
+    The backend is built with the same generator, pass it to Mandelbrot as
+    functools.partial(MemoryCachedTileManager, backend=NumpyCompressedTileManager)
+    """
+    max_bytes = 256 << 20
+
+    def __init__(self, generator, backend=CachelessTileManager, max_bytes=None, **kwargs):
+        super(MemoryCachedTileManager, self).__init__(generator)
+        self.backend = backend(generator=generator, **kwargs)
+        self.cache = LRUCache(max_bytes or self.max_bytes, sizeof=tile_nbytes)
+
+    @property
+    def stats(self):
+        return {'hits': self.cache.hits, 'misses': self.cache.misses, 'evictions': self.cache.evictions,
+                'bytes': self.cache.nbytes, 'tiles': len(self.cache)}
 
-        if path.exists(filename):
-            return np.load(filename)['mandel_data']
+    @property
+    def flight_stats(self):
+        # Misses are made by the backend
+        return self.backend.flight_stats
 
-        data = self.generate_tile_data(tile)
-        np.savez_compressed(filename, mandel_data=data)
+    def remember(self, tile, data):
+        # Every caller shares the cached array, nobody gets to scribble on it
+        data.setflags(write=False)
+        self.cache.put(self.get_tile_key(tile), data)
         return data
 
+    def get_tile_data(self, tile):
+        tile, flipped = self.canonical_tile(tile)
+        data = self.cache.get(self.get_tile_key(tile))
+        if data is None:
+            data = self.remember(tile, self.backend.get_tile_data(tile))
+        return data[::-1] if flipped else data
+
+    def get_tiles_data(self, tiles):
+        return self.mirrored(tiles, self.get_canonical_tiles_data)
+
+    def get_canonical_tiles_data(self, tiles):
+        misses = []
+        for tile in tiles:
+            data = self.cache.get(self.get_tile_key(tile))
+            if data is None:
+                misses.append(tile)
+            else:
+                yield tile, data
+
+        for tile, data in self.backend.get_tiles_data(misses):
+            yield tile, self.remember(tile, data)
+
+    def load_tile_data(self, tile):
+        data = self.cache.get(self.get_tile_key(tile))
+        if data is None:
+            data = self.backend.load_tile_data(tile)
+            if data is not None:
+                self.remember(tile, data)
+        return data
+
+    def tile_stored(self, tile):
+        return self.get_tile_key(tile) in self.cache or self.backend.tile_stored(tile)
+
+    def store_tile_data(self, tile, data):
+        self.backend.store_tile_data(tile, self.remember(tile, data))
+
+    def load_tile_state(self, tile):
+        return self.backend.load_tile_state(tile)
+
+    def store_tile_state(self, tile, state):
+        self.backend.store_tile_state(tile, state)
+
+    def close(self):
+        self.backend.close()
+
 
 from hashlib import md5
+import atexit
+import time
+import weakref
+import zlib
+from io import BytesIO
 import ZODB
 from BTrees.OOBTree import BTree
 import transaction
 import ZODB.FileStorage, zc.zlibstorage
 
 
+def pack_arrays(**arrays):
+    buf = BytesIO()
+    np.savez(buf, **arrays)
+    return zlib.compress(buf.getvalue())
+
+
+def unpack_arrays(blob):
+    return np.load(BytesIO(zlib.decompress(blob)))
+
+
+def flush_at_exit(manager):
+    """
+    Flushes manager's buffered writes when the interpreter exits, without keeping manager alive until then
+    """
+    manager = weakref.ref(manager)
+
+    def flush():
+        if manager() is not None:
+            manager().flush()
+    atexit.register(flush)
+
+
 class ZODBTileManager(TileManager):
-    def __init__(self, *args, **kwargs):
-        storage = zc.zlibstorage.ZlibStorage(
-            ZODB.FileStorage.FileStorage('data/zodb.fs'))
-        db = ZODB.DB(storage)
-        connection = db.open()
-        root = connection.root
-        root.tile_data = BTree()
-        self.tile_data = root.tile_data
+    """
+    Keeps every tile as a codec blob in a BTree in a ZODB FileStorage
+
+    The codec compresses tiles and states are packed with zlib, so the storage does not compress records again. It
+    still reads the records of stores that ZlibStorage compressed.
+    Writes are buffered and committed together once they reach commit_bytes, or commit_seconds after the last commit
+    whether or not more writes come. Each thread reads through its own connection and transaction manager out of the
+    DB's pool. FileStorage only opens in one process at a time, pack compacts it offline.
+    """
+    filename = 'data/zodb.fs'
+    commit_bytes = 16 << 20
+    commit_seconds = 10
+    codec = TileCodec()
 
+    def __init__(self, *args, **kwargs):
         super(ZODBTileManager, self).__init__(*args, **kwargs)
+        self.db = self.open_db(self.filename)
+        self.local = threading.local()
+        self.pending_lock = threading.Lock()
+        self.commit_lock = threading.Lock()
+        # md5 key to (tile blob or TileState, bytes), kept readable until it is committed
+        self.pending = {}
+        self.pending_bytes = 0
+        self.last_commit = time.time()
+        self.commits = 0
+
+        # Reopen the tree a previous run left behind
+        transaction_manager, connection = self.open_connection()
+        if 'tile_data' not in connection.root():
+            connection.root.tile_data = BTree()
+            transaction_manager.commit()
+
+        flush_at_exit(self)
+        self.stopping = threading.Event()
+        self.committer = threading.Thread(target=self.run_committer, name='tile committer')
+        self.committer.daemon = True
+        self.committer.start()
+
+    @staticmethod
+    def open_db(filename):
+        return ZODB.DB(zc.zlibstorage.ZlibStorage(ZODB.FileStorage.FileStorage(filename), compress=False))
+
+    def open_connection(self):
+        """
+        This thread's (transaction manager, connection), its snapshot moved up to the latest commit
+        """
+        if getattr(self.local, 'connection', None) is None:
+            self.local.transaction_manager = transaction.TransactionManager()
+            self.local.connection = self.db.open(self.local.transaction_manager)
+            self.local.commits = self.commits
+
+        if self.local.commits != self.commits:
+            # Ending the read transaction lets the connection see what other threads committed since
+            self.local.transaction_manager.abort()
+            self.local.commits = self.commits
+        return self.local.transaction_manager, self.local.connection
+
+    @property
+    def tile_data(self):
+        return self.open_connection()[1].root.tile_data
+
+    def get_key(self, key):
+        return md5(key.encode('ascii')).digest()
+
+    def load(self, key):
+        with self.pending_lock:
+            pending = self.pending.get(key)
+        if pending is not None:
+            return pending[0]
+        return self.tile_data.get(key)
+
+    def store(self, key, value, nbytes):
+        with self.pending_lock:
+            if key in self.pending:
+                self.pending_bytes -= self.pending[key][1]
+            self.pending[key] = value, nbytes
+            self.pending_bytes += nbytes
+            due = self.pending_bytes >= self.commit_bytes or time.time() - self.last_commit >= self.commit_seconds
+
+        if due:
+            self.flush()
+
+    def load_tile_data(self, tile):
+        blob = self.load(self.get_key(self.get_tile_key(tile)))
+        # Tiles stored before the codec are the arrays themselves
+        if isinstance(blob, np.ndarray):
+            return blob
+        if blob is not None:
+            return self.codec.decode(blob)
+
+    def tile_stored(self, tile):
+        key = self.get_key(self.get_tile_key(tile))
+        with self.pending_lock:
+            if key in self.pending:
+                return True
+        return key in self.tile_data
+
+    def store_tile_data(self, tile, data):
+        blob = self.codec.encode(data, self.generator.iterations)
+        self.store(self.get_key(self.get_tile_key(tile)), blob, len(blob))
+
+    def load_tile_state(self, tile):
+        stored = self.load(self.get_key(self.get_state_key(tile)))
+        # Older stores kept the TileState itself
+        if stored is None or isinstance(stored, TileState):
+            return stored
+        stored = unpack_arrays(stored)
+        return TileState(escape=stored['escape'], live=stored['live'], z=stored['z'],
+                         iterations=int(stored['iterations']))
+
+    def store_tile_state(self, tile, state):
+        blob = pack_arrays(**state._asdict())
+        self.store(self.get_key(self.get_state_key(tile)), blob, len(blob))
+
+    def run_committer(self):
+        # Commits writes left pending for commit_seconds when no store comes along to do it, at most commit_seconds
+        # late
+        while True:
+            with self.pending_lock:
+                wait = self.last_commit + self.commit_seconds - time.time() if self.pending else self.commit_seconds
+            if self.stopping.wait(max(wait, 0)):
+                break
+            with self.pending_lock:
+                due = self.pending and time.time() - self.last_commit >= self.commit_seconds
+            if due:
+                try:
+                    self.flush()
+                except Exception:
+                    log.exception("Committing tiles failed")
+        if getattr(self.local, 'connection', None) is not None:
+            self.local.connection.close()
+
+    def flush(self):
+        """
+        Commits every buffered write in a single transaction
+        """
+        with self.commit_lock:
+            with self.pending_lock:
+                batch = dict(self.pending)
+            if not batch:
+                return
+
+            transaction_manager, connection = self.open_connection()
+            connection.root.tile_data.update(dict((key, value) for key, (value, _) in batch.items()))
+            transaction_manager.commit()
+            log.debug("Committed {} tiles".format(len(batch)))
+
+            with self.pending_lock:
+                for key, pending in batch.items():
+                    if self.pending.get(key) is pending:
+                        del self.pending[key]
+                        self.pending_bytes -= pending[1]
+                self.last_commit = time.time()
+                self.commits += 1
+
+    def close(self):
+        self.stopping.set()
+        self.committer.join()
+        self.flush()
+        self.db.close()
+        super(ZODBTileManager, self).close()
+
+    @classmethod
+    def pack(cls, filename=None, keep_old=False):
+        """
+        Drops every old revision from the FileStorage, nothing else may have it open
+
+        FileStorage keeps the file it packed as filename.old, removed unless keep_old.
+        """
+        filename = filename or cls.filename
+        db = cls.open_db(filename)
+        before = os.path.getsize(filename)
+        try:
+            db.pack()
+        finally:
+            db.close()
+        log.info("Packed {} from {} to {} bytes".format(filename, before, os.path.getsize(filename)))
+
+        if not keep_old and os.path.exists(filename + '.old'):
+            os.remove(filename + '.old')
+
+
+import sqlite3
+
+
+class SQLiteTileManager(TileManager):
+    """
+    Keeps every tile as a codec blob in one sqlite database
+
+    The database runs in WAL mode, so render processes can read while a seeder writes. Writes made by get_tiles_data
+    are buffered and go in batch_inserts at a time, in one transaction, and are all in by the time it is done. Single
+    tiles from get_tile_data go in straight away. Each thread gets its own connection.
+    """
+    filename = 'data/tiles.sqlite'
+    batch_inserts = 64
+    codec = TileCodec()
+
+    def __init__(self, *args, **kwargs):
+        super(SQLiteTileManager, self).__init__(*args, **kwargs)
+        self.local = threading.local()
+        self.pending_lock = threading.Lock()
+        self.pending_tiles = {}
+        self.pending_states = {}
+        # Every thread's connection, for close
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        with self.connection as connection:
+            # x and y outgrow sqlite's 64 bit integers on deep zooms
+            connection.execute("""CREATE TABLE IF NOT EXISTS tiles (
+                                  z INTEGER, x TEXT, y TEXT, tile_size INTEGER, iterations INTEGER, aligned INTEGER,
+                                  data BLOB,
+                                  PRIMARY KEY (z, x, y, tile_size, iterations, aligned))""")
+            connection.execute("""CREATE TABLE IF NOT EXISTS states (
+                                  z INTEGER, x TEXT, y TEXT, tile_size INTEGER, aligned INTEGER,
+                                  data BLOB,
+                                  PRIMARY KEY (z, x, y, tile_size, aligned))""")
+
+        flush_at_exit(self)
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            # Only ever used by its own thread, but closed by whichever thread closes the manager
+            connection = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # WAL stays consistent on a crash with NORMAL, it only loses the last commits
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def tile_row(self, tile):
+        generator = self.generator
+        return tile.z, str(tile.x), str(tile.y), generator.tile_size, generator.iterations, int(generator.aligned)
+
+    def state_row(self, tile):
+        generator = self.generator
+        return tile.z, str(tile.x), str(tile.y), generator.tile_size, int(generator.aligned)
+
+    def load_tile_data(self, tile):
+        row = self.tile_row(tile)
+        with self.pending_lock:
+            blob = self.pending_tiles.get(row)
+
+        if blob is None:
+            found = self.connection.execute(
+                'SELECT data FROM tiles WHERE z=? AND x=? AND y=? AND tile_size=? AND iterations=? AND aligned=?',
+                row).fetchone()
+            if found is None:
+                return None
+            blob = found[0]
+
+        return self.codec.decode(blob)
+
+    def tile_stored(self, tile):
+        row = self.tile_row(tile)
+        with self.pending_lock:
+            if row in self.pending_tiles:
+                return True
+        return self.connection.execute(
+            'SELECT 1 FROM tiles WHERE z=? AND x=? AND y=? AND tile_size=? AND iterations=? AND aligned=?',
+            row).fetchone() is not None
+
+    def store_tile_data(self, tile, data):
+        with self.pending_lock:
+            self.pending_tiles[self.tile_row(tile)] = sqlite3.Binary(self.codec.encode(data, self.generator.iterations))
+            full = len(self.pending_tiles) + len(self.pending_states) >= self.batch_inserts
+
+        if full:
+            self.flush()
+
+    def load_tile_state(self, tile):
+        row = self.state_row(tile)
+        with self.pending_lock:
+            blob = self.pending_states.get(row)
+
+        if blob is None:
+            found = self.connection.execute(
+                'SELECT data FROM states WHERE z=? AND x=? AND y=? AND tile_size=? AND aligned=?', row).fetchone()
+            if found is None:
+                return None
+            blob = found[0]
+
+        stored = unpack_arrays(blob)
+        return TileState(escape=stored['escape'], live=stored['live'], z=stored['z'],
+                         iterations=int(stored['iterations']))
+
+    def store_tile_state(self, tile, state):
+        with self.pending_lock:
+            self.pending_states[self.state_row(tile)] = sqlite3.Binary(pack_arrays(**state._asdict()))
+        self.flush()
 
     def get_tile_data(self, tile):
-        key = md5(self.get_tile_key(tile)).digest()
-        if key in self.tile_data:
-            log.info('Got tile data')
-            return self.tile_data[key]
+        data = super(SQLiteTileManager, self).get_tile_data(tile)
+        # Nothing else would flush a tile server's misses before a crash
+        self.flush()
+        return data
+
+    def get_tiles_data(self, tiles):
+        for tile, data in super(SQLiteTileManager, self).get_tiles_data(tiles):
+            yield tile, data
+        self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered tile in a single transaction
+        """
+        with self.pending_lock:
+            tiles, self.pending_tiles = self.pending_tiles, {}
+            states, self.pending_states = self.pending_states, {}
+
+        if not tiles and not states:
+            return
+
+        with self.connection as connection:
+            connection.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   [row + (blob,) for row, blob in tiles.items()])
+            connection.executemany('INSERT OR REPLACE INTO states VALUES (?, ?, ?, ?, ?, ?)',
+                                   [row + (blob,) for row, blob in states.items()])
+
+    def close(self):
+        self.flush()
+        with self.connections_lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            connection.close()
+        super(SQLiteTileManager, self).close()
+
+
+class BoundedDiskTileManager(NumpyCompressedTileManager):
+    """
+    A NumpyCompressedTileManager whose directory is kept under max_bytes by evicting files in the background
+
+    Every file in root gets a GreedyDual priority, the inflation at its last use plus what it took to make per byte.
+    A background thread drops the lowest priorities, cheap and long unused files, until the directory is back under
+    evict_to of max_bytes, and the inflation rises to the last priority evicted so older uses count for less. The
+    priorities live in an sqlite index in root. Loads and stores only note what they touched in memory, the thread
+    writes it to the index every evict_seconds, so rendering never waits on it. Files the index has not seen, left by
+    earlier runs or mandelbrot_cstyle, are taken in at unknown_cost.
+    """
+    max_bytes = 4 << 30
+    evict_to = 0.9
+    evict_seconds = 10
+    # Seconds charged for files whose cost was never measured
+    unknown_cost = 1.0
+    # Floor on measured costs, tiles built out of stored ones are nearly free
+    min_cost = 1e-3
+    index_name = 'index.sqlite'
+
+    def __init__(self, *args, **kwargs):
+        max_bytes = kwargs.pop('max_bytes', None)
+        super(BoundedDiskTileManager, self).__init__(*args, **kwargs)
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+        if not path.isdir(self.root):
+            os.makedirs(self.root)
+
+        self.local = threading.local()
+        self.touched_lock = threading.Lock()
+        # File name to (bytes or None, cost or None, access time) since the index was last written
+        self.touched = {}
+        self.evictions = 0
+        self.stopping = threading.Event()
+        self.evictor = threading.Thread(target=self.run_evictor, name='tile evictor')
+        self.evictor.daemon = True
+        self.evictor.start()
+
+    def touch(self, name, nbytes=None, cost=None):
+        with self.touched_lock:
+            self.touched[name] = nbytes, cost, time.time()
+
+    def elapsed(self):
+        # Seconds since this thread started making what it is storing now
+        started, self.local.started = getattr(self.local, 'started', None), None
+        return max(time.time() - started if started is not None else 0, self.min_cost)
+
+    def make_tile_data(self, tile):
+        self.local.started = time.time()
+        return super(BoundedDiskTileManager, self).make_tile_data(tile)
 
-        data = self.generate_tile_data(tile)
+    def generate_tiles_data(self, tiles):
+        # Tiles come out of a batch one after the other, each is charged the time since the one before
+        self.local.started = time.time()
+        for tile, data in super(BoundedDiskTileManager, self).generate_tiles_data(tiles):
+            yield tile, data
+            self.local.started = time.time()
 
-        self.tile_data[key] = data
-        transaction.commit()
+    def load_tile_data(self, tile):
+        data = super(BoundedDiskTileManager, self).load_tile_data(tile)
+        if data is not None:
+            name = self.get_tile_key(tile) + '.tile'
+            self.touch(name if path.exists(self.root + name) else self.get_tile_key(tile) + '.npz')
         return data
 
+    def touch_stored(self, name):
+        cost = self.elapsed()
+        try:
+            nbytes = path.getsize(self.root + name)
+        except OSError:
+            # Evicted already
+            return
+        self.touch(name, nbytes, cost)
+
+    def store_tile_data(self, tile, data):
+        super(BoundedDiskTileManager, self).store_tile_data(tile, data)
+        self.touch_stored(self.get_tile_key(tile) + '.tile')
+
+    def load_tile_state(self, tile):
+        state = super(BoundedDiskTileManager, self).load_tile_state(tile)
+        if state is not None:
+            self.touch(self.get_state_key(tile) + '.npz')
+        return state
+
+    def store_tile_state(self, tile, state):
+        super(BoundedDiskTileManager, self).store_tile_state(tile, state)
+        self.touch_stored(self.get_state_key(tile) + '.npz')
+
+    def run_evictor(self):
+        connection = sqlite3.connect(path.join(self.root, self.index_name), timeout=30)
+        connection.execute('PRAGMA journal_mode=WAL')
+        with connection:
+            connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                                  name TEXT PRIMARY KEY, bytes INTEGER, cost REAL, priority REAL, accessed REAL)""")
+            connection.execute('CREATE INDEX IF NOT EXISTS files_priority ON files (priority)')
+            connection.execute('CREATE TABLE IF NOT EXISTS inflation (value REAL)')
+            if connection.execute('SELECT COUNT(*) FROM inflation').fetchone()[0] == 0:
+                connection.execute('INSERT INTO inflation VALUES (0)')
+
+        try:
+            self.index_unknown(connection)
+            while True:
+                stopping = self.stopping.wait(self.evict_seconds)
+                self.write_index(connection)
+                if stopping:
+                    break
+                self.evict(connection)
+        except Exception:
+            log.exception("Tile evictor stopped")
+        finally:
+            connection.close()
+
+    def index_unknown(self, connection):
+        """
+        Takes every tile and state file in root the index does not have into it
+        """
+        known = set(name for name, in connection.execute('SELECT name FROM files'))
+        inflation, = connection.execute('SELECT value FROM inflation').fetchone()
+        rows = []
+        for name in os.listdir(self.root):
+            if name in known or not (name.endswith('.tile') or name.endswith('.npz')):
+                continue
+            try:
+                stat = os.stat(self.root + name)
+            except OSError:
+                continue
+            rows.append((name, stat.st_size, self.unknown_cost, inflation + self.unknown_cost / max(stat.st_size, 1),
+                         stat.st_mtime))
+
+        with connection:
+            connection.executemany('INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?, ?)', rows)
+        if rows:
+            log.info("Indexed {} tile files".format(len(rows)))
+
+    def write_index(self, connection):
+        with self.touched_lock:
+            touched, self.touched = self.touched, {}
+        if not touched:
+            return
+
+        with connection:
+            inflation, = connection.execute('SELECT value FROM inflation').fetchone()
+            for name, (nbytes, cost, accessed) in touched.items():
+                if nbytes is not None:
+                    connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                       (name, nbytes, cost, inflation + cost / max(nbytes, 1), accessed))
+                else:
+                    # Loaded, it goes back up to the current inflation
+                    connection.execute('UPDATE files SET priority = ? + cost / MAX(bytes, 1), accessed = ? '
+                                       'WHERE name = ?', (inflation, accessed, name))
+
+    def evict(self, connection):
+        """
+        Removes the lowest priority files until the directory is under evict_to of max_bytes
+        """
+        total, = connection.execute('SELECT COALESCE(SUM(bytes), 0) FROM files').fetchone()
+        if total <= self.max_bytes:
+            return
+
+        target = self.max_bytes * self.evict_to
+        # Files used since the index was written are not the ones to drop
+        with self.touched_lock:
+            in_use = set(self.touched)
+        evicted = []
+        inflation = None
+        for name, nbytes, priority in connection.execute('SELECT name, bytes, priority FROM files ORDER BY priority'):
+            if total <= target:
+                break
+            if name in in_use:
+                continue
+            try:
+                os.remove(self.root + name)
+            except OSError:
+                pass
+            evicted.append((name,))
+            total -= nbytes
+            inflation = priority
+
+        with connection:
+            connection.executemany('DELETE FROM files WHERE name = ?', evicted)
+            if inflation is not None:
+                connection.execute('UPDATE inflation SET value = MAX(value, ?)', (inflation,))
+        self.evictions += len(evicted)
+        log.info("Evicted {} tile files, {} bytes left".format(len(evicted), total))
+
+    def close(self):
+        self.stopping.set()
+        self.evictor.join()
+        super(BoundedDiskTileManager, self).close()
+
+
+import fcntl
+
+
+class MemmapTileManager(TileManager):
+    """
+    Keeps tiles as fixed size uncompressed records in memory mapped slab files, in the narrowest type that fits
+
+    get_tile_data hands out read-only views straight into the mapping, so a hit copies nothing and the page cache is
+    shared by every process on the host. An append-only index file maps tiles to record numbers, writers take an
+    exclusive lock on it to claim the next record.
+    """
+    root = 'data/memmap/'
+    # Records per slab file
+    slab_records = 256
+
+    def __init__(self, *args, **kwargs):
+        super(MemmapTileManager, self).__init__(*args, **kwargs)
+        generator = self.generator
+
+        # Every record in a directory has the same size
+        self.directory = path.join(self.root, 'D{}I{}{}'.format(generator.tile_size, generator.iterations,
+                                                                'A' if generator.aligned else ''))
+        if not path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.shape = (generator.tile_size, generator.tile_size)
+        self.dtype = escape_dtype(generator.iterations)
+        self.record_bytes = np.dtype(self.dtype).itemsize * generator.tile_size**2
+        self.index_filename = path.join(self.directory, 'index')
+        self.index = {}
+        self.index_offset = 0
+        # Records in use, uniform tiles have none
+        self.records = 0
+        self.slabs = {}
+        self.lock = threading.Lock()
+
+    def slab_filename(self, slab):
+        return path.join(self.directory, 'slab{}'.format(slab))
+
+    def read_index(self):
+        # Picks up whatever other processes appended since the last read
+        if not path.exists(self.index_filename):
+            return
+
+        with open(self.index_filename, 'r') as index_file:
+            index_file.seek(self.index_offset)
+            for line in iter(index_file.readline, ''):
+                if not line.endswith('\n'):
+                    # Half written, take it next time
+                    break
+                z, x, y, record = line.split()
+                # Uniform tiles are just their value, u<value>, and take no record
+                if record.startswith('u'):
+                    self.index[(int(z), int(x), int(y))] = record
+                else:
+                    self.index[(int(z), int(x), int(y))] = int(record)
+                    self.records = max(self.records, int(record) + 1)
+                self.index_offset += len(line)
+
+    def slab(self, number):
+        slab = self.slabs.get(number)
+        if slab is None:
+            slab = np.memmap(self.slab_filename(number), dtype=self.dtype, mode='r',
+                             shape=(self.slab_records,) + self.shape)
+            self.slabs[number] = slab
+        return slab
+
+    def load_tile_data(self, tile):
+        key = (tile.z, tile.x, tile.y)
+        with self.lock:
+            if key not in self.index:
+                self.read_index()
+            record = self.index.get(key)
+
+        if record is None:
+            return None
+        if not isinstance(record, int):
+            return uniform_tile(int(record[1:]), self.shape, self.dtype)
+
+        slab, slot = divmod(record, self.slab_records)
+        return self.slab(slab)[slot]
+
+    def store_tile_data(self, tile, data):
+        key = (tile.z, tile.x, tile.y)
+        with self.lock, open(self.index_filename, 'a+') as index_file:
+            fcntl.flock(index_file, fcntl.LOCK_EX)
+            try:
+                self.read_index()
+                if key in self.index:
+                    return
+
+                value = uniform_value(data)
+                if value is not None:
+                    index_file.write('{} {} {} u{}\n'.format(tile.z, tile.x, tile.y, value))
+                    index_file.flush()
+                    return
+
+                record = self.records
+                slab, slot = divmod(record, self.slab_records)
+                filename = self.slab_filename(slab)
+
+                with open(filename, 'r+b' if path.exists(filename) else 'w+b') as slab_file:
+                    if slot == 0:
+                        slab_file.truncate(self.slab_records * self.record_bytes)
+                    slab_file.seek(slot * self.record_bytes)
+                    slab_file.write(np.ascontiguousarray(data, self.dtype).tobytes())
 
+                # The record is in place before the index points at it
+                index_file.write('{} {} {} {}\n'.format(tile.z, tile.x, tile.y, record))
+                index_file.flush()
+                self.records += 1
+            finally:
+                fcntl.flock(index_file, fcntl.LOCK_UN)
@@ -1,4 +1,7 @@
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from numpy.lib.stride_tricks import as_strided
+import numpy as np
+import threading
 
 
 def transform_index(x, y, z):
@@ -11,5 +14,110 @@ def transform_real(u, v, z):
     return (2**z)*u, (2**z)*v
 
 
+def tile_children(tile):
+    # The four tiles at z+1 covering tile: top left, top right, bottom left, bottom right
+    x, y, z = 2*tile.x, 2*tile.y, tile.z+1
+    return [tile._replace(x=x, y=y, z=z), tile._replace(x=x+1, y=y, z=z),
+            tile._replace(x=x, y=y-1, z=z), tile._replace(x=x+1, y=y-1, z=z)]
+
+
+def tile_parent(tile):
+    # The tile at z-1 covering tile, and which of its quarters tile is as (row, col)
+    return tile._replace(x=tile.x // 2, y=(tile.y + 1) // 2, z=tile.z-1), tile.y % 2, tile.x % 2
+
+
+def tile_mirror(tile):
+    # The tile across the real axis, tile y spans y-1 to y so its mirror spans -y to 1-y
+    return tile._replace(y=1-tile.y)
+
+
+def uniform_tile(value, shape, dtype):
+    """
+    A read-only array of shape where every pixel is value, backed by that one value
+    """
+    tile = as_strided(np.array([value], dtype), shape=shape, strides=(0,) * len(shape))
+    tile.setflags(write=False)
+    return tile
+
+
+def uniform_value(data):
+    # The value of a tile made by uniform_tile, None for any other tile
+    if data.size and not any(data.strides):
+        return data.flat[0]
+    return None
+
+
+def elide_uniform(data):
+    """
+    Swaps a tile whose pixels all match for a uniform_tile
+    """
+    if uniform_value(data) is None and data.size and (data == data.flat[0]).all():
+        return uniform_tile(data.flat[0], data.shape, data.dtype)
+    return data
+
+
+def tile_nbytes(data):
+    # What data actually takes up, a uniform tile is one value
+    return data.itemsize if uniform_value(data) is not None else data.nbytes
+
+
 RenderSet = namedtuple('RenderSet', 'apparent_tile_size data_tiles')
 DataTile = namedtuple('DataTile', 'x y z pix_x pix_y')
+# The escape counts of a tile computed to iterations, and the orbits it can carry on from
+# live holds the flat indices of the pixels still being iterated, z where their orbits are
+TileState = namedtuple('TileState', 'escape live z iterations')
+
+
+class LRUCache(object):
+    """
+    A thread safe mapping that drops the least recently used items once they take up more than max_bytes
+
+    Items are sized with sizeof, their nbytes by default. Counts its hits, misses and evictions.
+    """
+
+    def __init__(self, max_bytes, sizeof=lambda value: value.nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+
+            self.hits += 1
+            # Most recently used goes last
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.items:
+                self.nbytes -= self.sizeof(self.items.pop(key))
+
+            self.items[key] = value
+            self.nbytes += size
+
+            while self.nbytes > self.max_bytes and self.items:
+                _, evicted = self.items.popitem(last=False)
+                self.nbytes -= self.sizeof(evicted)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        with self.lock:
+            return len(self.items)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
@@ -0,0 +1,149 @@
+"""
+Zoom videos out of a few oversized keyframes
+
+Successive frames of a zoom only differ by a tiny scale, so rather than composing every frame from tiles a keyframe is
+rendered every spacing steps of z, big enough to hold every frame up to the next keyframe at full resolution. The
+frames in between are cropped out of it and scaled down.
+
+FrameScheduler renders frames in worker processes, each with its own Mandelbrot, and hands them back in order.
+"""
+from __future__ import division
+from collections import OrderedDict, deque
+from math import ceil, floor
+import multiprocessing
+from PIL import Image
+import numpy as np
+import logging
+logging.basicConfig(level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+from . import Mandelbrot
+
+
+class KeyframeZoom(object):
+    """
+    Renders the frames of a zoom into u, v starting at start_z
+
+    :param size: (w, h) of the frames
+    :param spacing: z between keyframes, smaller is sharper and renders more keyframes, keyframes are 2**spacing times
+        the frame size
+    :param crossfade: z over which the frames fade from one keyframe into the next, 0 cuts straight over, at most
+        spacing, keyframes grow another 2**crossfade times to cover it
+    Everything else is handed to Mandelbrot to render the keyframes.
+    """
+    spacing = 1
+    crossfade = 0
+    resample_method = Image.LANCZOS
+    # Frames move forward through the zoom, only the keyframes either side of the current one are needed
+    keep_keyframes = 2
+
+    def __init__(self, u, v, start_z, size, spacing=None, crossfade=None, **mandelbrot_kwargs):
+        self.u = u
+        self.v = v
+        self.start_z = start_z
+        self.w, self.h = size
+        if spacing is not None:
+            self.spacing = spacing
+        if crossfade is not None:
+            self.crossfade = crossfade
+        if not 0 <= self.crossfade <= self.spacing:
+            raise ValueError("crossfade has to be between 0 and spacing, got {}".format(self.crossfade))
+
+        scale = 2**(self.spacing + self.crossfade)
+        self.keyframe_size = int(ceil(self.w * scale)), int(ceil(self.h * scale))
+        self.mandelbrot = Mandelbrot(size=self.keyframe_size, **mandelbrot_kwargs)
+        self.keyframes = OrderedDict()
+
+    def keyframe_z(self, index):
+        """
+        The z of the sharpest frame keyframe index holds, it holds frames back to spacing + crossfade below that
+        """
+        return self.start_z + (index + 1) * self.spacing
+
+    def keyframe(self, index):
+        if index not in self.keyframes:
+            z = self.keyframe_z(index)
+            log.debug("Rendering keyframe {} at z={} {}x{}".format(index, z, *self.keyframe_size))
+            # Renderers may reuse their frame, the keyframe needs its own copy
+            self.keyframes[index] = Image.fromarray(np.array(self.mandelbrot.render_frame(self.u, self.v, z)), 'RGB')
+            while len(self.keyframes) > self.keep_keyframes:
+                self.keyframes.popitem(last=False)
+        return self.keyframes[index]
+
+    def crop(self, index, z):
+        """
+        The frame at z scaled out of keyframe index
+        """
+        keyframe_w, keyframe_h = self.keyframe_size
+        # Frames shrink by half in the keyframe for every step of z towards its sharpest frame
+        scale = 2**(z - self.keyframe_z(index))
+        half_w, half_h = self.w / scale / 2, self.h / scale / 2
+        box = (keyframe_w/2 - half_w, keyframe_h/2 - half_h, keyframe_w/2 + half_w, keyframe_h/2 + half_h)
+        return self.keyframe(index).resize((self.w, self.h), resample=self.resample_method, box=box)
+
+    def render_frame(self, z):
+        """
+        The (h, w, 3) uint8 frame at z, which should not be below start_z
+        """
+        index = max(int(floor((z - self.start_z) / self.spacing)), 0)
+        frame = self.crop(index, z)
+
+        if self.crossfade:
+            # How far z has come into the part of the next keyframe that overlaps this one
+            fade = (z - (self.keyframe_z(index) - self.crossfade)) / self.crossfade
+            if fade > 0:
+                frame = Image.blend(frame, self.crop(index + 1, z), min(fade, 1))
+
+        return np.asarray(frame)
+
+
+# Set in each worker by init_frame_worker
+worker_mandelbrot = None
+
+
+def init_frame_worker(mandelbrot_kwargs):
+    global worker_mandelbrot
+    worker_mandelbrot = Mandelbrot(**mandelbrot_kwargs)
+
+
+def render_frame_worker(u, v, z):
+    # Renderers may hand back their reused frame, pickling copies it anyway
+    return np.asarray(worker_mandelbrot.render_frame(u, v, z))
+
+
+class FrameScheduler(object):
+    """
+    Renders frames across worker processes, each building its own Mandelbrot out of mandelbrot_kwargs
+
+    At most window frames are in flight or waiting to be handed out, so memory stays bounded however long the video.
+    The workers only share tiles through the tile manager's storage, pick one that several processes can open at
+    once, SQLiteTileManager, MemmapTileManager or NumpyCompressedTileManager rather than ZODBTileManager.
+    """
+
+    def __init__(self, workers=None, window=None, **mandelbrot_kwargs):
+        self.workers = workers or multiprocessing.cpu_count()
+        # Twice the workers keeps every worker busy while the oldest frame is waited on
+        self.window = window or 2 * self.workers
+        self.pool = multiprocessing.Pool(self.workers, init_frame_worker, (mandelbrot_kwargs,))
+
+    def render_frames(self, frames):
+        """
+        Yields the (h, w, 3) uint8 frame for every (u, v, z) in frames, in order
+        """
+        frames = iter(frames)
+        pending = deque()
+
+        while True:
+            while len(pending) < self.window:
+                frame = next(frames, None)
+                if frame is None:
+                    break
+                pending.append(self.pool.apply_async(render_frame_worker, frame))
+
+            if not pending:
+                return
+            yield pending.popleft().get()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
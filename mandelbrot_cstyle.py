@@ -9,6 +9,10 @@ from math import floor, ceil
 from os import path
 import colorsys
 from PIL import Image, ImageDraw
+from mandelbrot.compat import xrange
+from mandelbrot.generators import PERIODICITY_TOLERANCE
+from mandelbrot.palettes import palette_lut, colorize
+from mandelbrot.util import LRUCache
 import logging
 logging.basicConfig(level=logging.DEBUG)
 log = logging.getLogger(__name__)
@@ -77,15 +81,15 @@ def generate_pil_viewport(u, v, z, dpu, w, h, max_i, palette):
     return img
 
 
-mandelbrot_colored_memcache = {}
+mandelbrot_colored_memcache = LRUCache(max_bytes=256 << 20)
 def get_colored_mandelbrot_matrix(tile_x, tile_y, tile_z, dpu, max_i, palette):
     filename = index_to_filename(tile_x, tile_y, tile_z, dpu, max_i) + '.png'
 
-    if filename in mandelbrot_colored_memcache:
-        return mandelbrot_colored_memcache[filename]
-
-    mandelbrot_colored_memcache[filename] = generate_colored_mandelbrot_matrix(tile_x, tile_y, tile_z, dpu, max_i, palette)
-    return mandelbrot_colored_memcache[filename]
+    colored = mandelbrot_colored_memcache.get(filename)
+    if colored is None:
+        colored = generate_colored_mandelbrot_matrix(tile_x, tile_y, tile_z, dpu, max_i, palette)
+        mandelbrot_colored_memcache.put(filename, colored)
+    return colored
 
 
 def generate_tileset_coords(x, y, tile_size, w, h):
@@ -110,23 +114,8 @@ def generate_tileset_coords(x, y, tile_size, w, h):
 def generate_colored_mandelbrot_matrix(x, y, z, dpu, max_i, palette):
     mandel_data = get_indexed_mandelbrot_matrix(x, y, z, dpu, max_i)
 
-    palette_length = len(palette)
-
-    @np.vectorize
-    def colorize_matrix(i):
-        if i == max_i:
-            return MAX_ITERATION_COLOR
-        else:
-            return palette[i % palette_length]
-
-    colorized_data = colorize_matrix(mandel_data)
-    # starts as a 3 tuple of dpuxdpu integers
-    colorized_data = np.uint8(np.array(colorized_data))
-    # Turns it into an array of uint8s
-    colorized_data = np.rollaxis(colorized_data, axis=0, start=3)
-    # Starts (3, 400, 400), rollaxis moves the color to the last place (400, 400, 3)
-
-    return colorized_data
+    # One lookup colors the whole (dpu, dpu) matrix into (dpu, dpu, 3)
+    return colorize(palette_lut(palette, MAX_ITERATION_COLOR, max_i), mandel_data)
 
 
 def index_to_filename(x, y, z, dpu, max_i):
@@ -186,16 +175,34 @@ def generate_mandelbrot_matrix(u0, u1, v0, v1, dpu, max_i):
     escape = np.empty((dpu, dpu), 'int32')
     escape[:,:] = max_i
 
+    # Points in the main cardioid and the period-2 bulb never escape, so they never enter the loop
+    q = (xs - 0.25)**2 + ys**2
+    mask = ~((q * (q + (xs - 0.25)) <= 0.25 * ys**2) | ((xs + 1)**2 + ys**2 <= 0.0625))
+
+    # Brent's cycle detection, orbits that come back to a saved z are in the set
+    tolerance = PERIODICITY_TOLERANCE * (u1 - u0) / dpu
+    saved = z.copy()
+    period = check_at = 1
+
     for i in xrange(1, max_i):
-        # we're just wrapping the numpy expression with `evaluate`
-        mask = ne.evaluate('escape == max_i')
         # boolean indexing is not too numexpr-friendly, so instead we use
         # the numpy function `where(cond,then,else)` and set z to 0
         # at already-escaped points, to avoid overflows
         z = ne.evaluate('where(mask,z**2+c,0)')
         # again where; taking the real part of abs is necessary here
         # because in numexpr abs(complex) is complex with 0 imaginary part
-        escape = ne.evaluate('where(mask & (abs(z).real > 2),i,escape)')
+        escaped = ne.evaluate('mask & (abs(z).real > 2)')
+        escape = ne.evaluate('where(escaped,i,escape)')
+        # retire escaped and cyclic points
+        mask = ne.evaluate('mask & ~escaped & ~(abs(z-saved).real < tolerance)')
+
+        if i == check_at:
+            saved = z.copy()
+            period *= 2
+            check_at += period
+
+        if not mask.any():
+            break
 
     return escape
 
@@ -286,7 +293,8 @@ def show_viewport():
     plt.imshow(generate_viewport(x, y, z, dpu=dpu, w=w, h=h, max_i=400, palette=palette), origin='upper')
     plt.show()
 
-show_viewport()
+if __name__ == '__main__':
+    show_viewport()
 
 def show_colored_mandelbrot_matrix():
     x, y, z = 0, 0, 0
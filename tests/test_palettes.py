@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from mandelbrot.palettes import blue_black_orange_white, colorize, palette_lut
+
+
+def test_colorize_cycles_palette_and_colors_inside_with_max_color():
+    palette = [(1, 2, 3), (4, 5, 6), (7, 8, 9)]
+    lut = palette_lut(palette, (0, 0, 0), iterations=5)
+    data = np.array([[0, 1, 2], [3, 4, 5]])
+
+    colored = colorize(lut, data)
+
+    assert colored.shape == (2, 3, 3) and colored.dtype == np.uint8
+    assert colored[0].tolist() == [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+    assert colored[1].tolist() == [[1, 2, 3], [4, 5, 6], [0, 0, 0]]
+
+
+def test_colorize_into_out():
+    lut = palette_lut(blue_black_orange_white(cycle_size=4), (0, 0, 0), iterations=10)
+    data = np.arange(12).reshape((3, 4)) % 11
+    out = np.empty((3, 4, 3), 'uint8')
+
+    assert colorize(lut, data, out=out) is out
+    assert (out == colorize(lut, data)).all()
+
+
+def test_palette_lut_wraps_channels_past_255():
+    # Palettes have handed in plain ints above 255, np.uint8 wrapped them
+    palette = [(256, 300, 45948), (255, 0, 1)]
+    lut = palette_lut(palette, (0, 0, 0), iterations=2)
+
+    assert lut[:2].tolist() == np.uint8(np.array(palette)).tolist()
+
+
+def test_cstyle_palette_colors(tmp_path, monkeypatch):
+    pytest.importorskip('matplotlib')
+    import mandelbrot_cstyle
+    monkeypatch.setattr(mandelbrot_cstyle, 'DATA_ROOT', str(tmp_path) + '/')
+
+    # gen_palette hands out channels far above 255
+    palette = mandelbrot_cstyle.gen_palette()
+    colored = mandelbrot_cstyle.generate_colored_mandelbrot_matrix(-1, 0, 0, dpu=16, max_i=50, palette=palette)
+
+    assert colored.shape == (16, 16, 3) and colored.dtype == np.uint8
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from mandelbrot.tile_codecs import COMPRESSORS, TileCodec, escape_dtype
+from mandelbrot.util import uniform_tile, uniform_value
+
+
+def escape_counts(iterations, size=32):
+    rng = np.random.RandomState(iterations)
+    # Runs of equal counts with a few jumps, like a real tile
+    return np.repeat(rng.randint(0, iterations + 1, (size, size // 4)), 4, axis=1).astype('int32')
+
+
+@pytest.mark.parametrize('compressor', [name for name, _, _ in COMPRESSORS])
+@pytest.mark.parametrize('delta', [False, True])
+@pytest.mark.parametrize('shuffle', [False, True])
+@pytest.mark.parametrize('iterations', [200, 5000, 100000])
+def test_round_trip(compressor, delta, shuffle, iterations):
+    codec = TileCodec(compressor, delta=delta, shuffle=shuffle)
+    data = escape_counts(iterations)
+
+    decoded = codec.decode(codec.encode(data, iterations))
+
+    assert decoded.dtype == escape_dtype(iterations)
+    assert (decoded == data).all()
+
+
+def test_uniform_tiles_store_one_value():
+    codec = TileCodec()
+    blob = codec.encode(np.full((64, 64), 7, 'int32'), 100)
+
+    decoded = codec.decode(blob)
+
+    assert len(blob) == TileCodec.header.size + 1
+    assert decoded.shape == (64, 64) and uniform_value(decoded) == 7
+    assert uniform_value(codec.decode(codec.encode(uniform_tile(7, (64, 64), 'int32'), 100))) == 7
+
+
+def test_decode_rejects_other_blobs():
+    with pytest.raises(ValueError):
+        TileCodec().decode(b'\0' * 32)
+
+
+def test_unknown_compressor():
+    with pytest.raises(ValueError):
+        TileCodec('snappy')
+
+
+def test_escape_dtype():
+    assert [escape_dtype(i).name for i in (255, 256, 65535, 65536)] == ['uint8', 'uint16', 'uint16', 'uint32']
@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+
+from mandelbrot.generators import NumexprGenerator
+from mandelbrot.tile_managers import CachelessTileManager, NumpyCompressedTileManager
+from mandelbrot.util import DataTile, tile_children
+
+TILE = DataTile(x=-2, y=1, z=1, pix_x=0, pix_y=0)
+
+
+class AlignedGenerator(NumexprGenerator):
+    aligned = True
+
+
+def tile_manager(tmp_path, generator, **attributes):
+    manager = NumpyCompressedTileManager(generator=generator)
+    manager.root = str(tmp_path) + '/'
+    for name, value in attributes.items():
+        setattr(manager, name, value)
+    return manager
+
+
+@pytest.mark.parametrize('iterations', [[50, 200], [200, 50], [50, 200, 100, 400]])
+def test_resumed_tiles_match_generated_ones(tmp_path, iterations):
+    # Each count either carries the stored state on or cuts it back
+    for count in iterations:
+        generator = NumexprGenerator(iterations=count, tile_size=32)
+        data = tile_manager(tmp_path, generator, resumable=True).get_tile_data(TILE)
+
+        assert (data == generator.generate_tile(TILE.x, TILE.y, TILE.z)).all()
+
+
+def test_resumable_keeps_only_the_state(tmp_path):
+    manager = tile_manager(tmp_path, NumexprGenerator(iterations=100, tile_size=32), resumable=True)
+    manager.get_tile_data(TILE)
+
+    assert [path.name for path in tmp_path.iterdir()] == [manager.get_state_key(TILE) + '.npz']
+    assert manager.has_tile_data(TILE)
+
+
+def test_resumable_rejects_workers():
+    with pytest.raises(ValueError):
+        type('Resumable', (CachelessTileManager,), {'resumable': True})(
+            NumexprGenerator(iterations=100, tile_size=32), workers=2)
+
+
+def test_pyramid_derives_parents_and_children(tmp_path):
+    generator = AlignedGenerator(iterations=200, tile_size=32)
+    manager = tile_manager(tmp_path, generator, reuse_pyramid=True)
+    expected = generator.generate_tile(TILE.x, TILE.y, TILE.z)
+
+    children = [manager.get_tile_data(child) for child in tile_children(TILE)]
+    # Built out of the four stored children without iterating
+    assert (manager.derive_tile_data(TILE) == expected).all()
+
+    for child in tile_children(TILE):
+        (tmp_path / (manager.get_tile_key(child) + '.tile')).unlink()
+    manager.store_tile_data(TILE, expected)
+    # A quarter of each comes from the parent, the rest is iterated
+    for child, data in zip(tile_children(TILE), children):
+        assert (manager.derive_tile_data(child) == data).all()
+
+
+def test_tiles_below_the_real_axis_are_mirrored():
+    generator = NumexprGenerator(iterations=200, tile_size=32)
+    manager = CachelessTileManager(generator=generator)
+    below = DataTile(x=-2, y=0, z=1, pix_x=0, pix_y=0)
+
+    tiles = dict(((tile.x, tile.y), data) for tile, data in manager.get_tiles_data([TILE, below]))
+
+    assert (tiles[below.x, below.y] == tiles[TILE.x, TILE.y][::-1]).all()
+    # Mirroring only moves the samples by rounding
+    assert np.mean(tiles[below.x, below.y] != generator.generate_tile(below.x, below.y, below.z)) < 0.01
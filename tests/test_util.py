@@ -0,0 +1,72 @@
+from fractions import Fraction
+
+import numpy as np
+
+from mandelbrot.util import (DataTile, LRUCache, elide_uniform, tile_children, tile_mirror, tile_parent,
+                             transform_index, uniform_tile, uniform_value)
+
+
+def tile_span(tile):
+    # (u0, u1, v0, v1) exactly, tile x spans u from x to x+1 and tile y v from y-1 to y
+    scale = Fraction(2)**tile.z
+    return tile.x / scale, (tile.x + 1) / scale, (tile.y - 1) / scale, tile.y / scale
+
+
+def test_children_cover_their_parent():
+    tile = DataTile(x=-3, y=2, z=4, pix_x=0, pix_y=0)
+    u0, u1, v0, v1 = tile_span(tile)
+    top_left, top_right, bottom_left, bottom_right = [tile_span(child) for child in tile_children(tile)]
+
+    assert top_left[0] == u0 and top_left[3] == v1
+    assert top_right[1] == u1 and top_right[3] == v1
+    assert bottom_left[0] == u0 and bottom_left[2] == v0
+    assert bottom_right[1] == u1 and bottom_right[2] == v0
+
+
+def test_parent_of_each_child():
+    tile = DataTile(x=-3, y=2, z=4, pix_x=0, pix_y=0)
+    quarters = [(0, 0), (0, 1), (1, 0), (1, 1)]
+
+    for child, quarter in zip(tile_children(tile), quarters):
+        parent, row, col = tile_parent(child)
+        assert parent == tile
+        assert (row, col) == quarter
+
+
+def test_mirror_spans_the_reflected_region():
+    for y in (-2, 0, 1, 3):
+        tile = DataTile(x=-1, y=y, z=2, pix_x=0, pix_y=0)
+        u0, u1, v0, v1 = tile_span(tile)
+
+        assert tile_span(tile_mirror(tile)) == (u0, u1, -v1, -v0)
+        assert tile_mirror(tile_mirror(tile)) == tile
+
+
+def test_transform_index():
+    assert transform_index(-3, 2, 2) == (-0.75, 0.5)
+
+
+def test_elide_uniform():
+    data = np.full((8, 8), 5, 'int32')
+    elided = elide_uniform(data)
+
+    assert uniform_value(elided) == 5 and not elided.flags.writeable
+    assert (elided == data).all()
+
+    data[0, 0] = 4
+    assert elide_uniform(data) is data
+    assert uniform_value(uniform_tile(3, (4, 4), 'uint8')) == 3
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(3 * 8, sizeof=lambda value: value.nbytes)
+    for key in 'abc':
+        cache.put(key, np.zeros(1))
+    cache.get('a')
+    cache.put('d', np.zeros(1))
+
+    assert 'b' not in cache
+    assert all(key in cache for key in 'acd')
+    assert len(cache) == 3 and cache.nbytes == 24
+    assert (cache.hits, cache.evictions) == (1, 1)
+    assert cache.get('b') is None and cache.misses == 1
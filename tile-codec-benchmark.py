@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Compares the size and decode speed of TileCodec settings against the old savez_compressed tiles
+from __future__ import division
+from io import BytesIO
+import timeit
+import numpy as np
+import logging
+logging.basicConfig(level=logging.INFO)
+log = logging.getLogger(__name__)
+
+from mandelbrot.generators import NumexprGenerator
+from mandelbrot.tile_codecs import TileCodec, COMPRESSORS
+
+ITERATIONS = 1000
+TILE_SIZE = 512
+# A coarse tile over the cardioid, one on the seahorse valley edge and one zoomed into it
+TILES = [(-2, 1, 1), (-3, 1, 2), (-767, 154, 10)]
+REPEATS = 20
+
+
+def npz_encode(data):
+    buf = BytesIO()
+    np.savez_compressed(buf, mandel_data=data)
+    return buf.getvalue()
+
+
+def npz_decode(blob):
+    return np.load(BytesIO(blob))['mandel_data']
+
+
+def benchmark(name, encode, decode, tiles):
+    size = 0
+    seconds = 0
+    for data in tiles:
+        blob = encode(data)
+        assert (decode(blob) == data).all()
+        size += len(blob)
+        seconds += min(timeit.repeat(lambda: decode(blob), number=1, repeat=REPEATS))
+
+    print("{:<16} {:>10} bytes {:>8.2f} ms/tile".format(name, size, 1000 * seconds / len(tiles)))
+
+
+def main():
+    generator = NumexprGenerator(iterations=ITERATIONS, tile_size=TILE_SIZE)
+    tiles = [generator.generate_tile(x, y, z) for x, y, z in TILES]
+
+    benchmark('npz', npz_encode, npz_decode, tiles)
+    for compressor, _, _ in COMPRESSORS:
+        for delta in (False, True):
+            for shuffle in (False, True):
+                codec = TileCodec(compressor=compressor, delta=delta, shuffle=shuffle)
+                benchmark('{}{}{}'.format(compressor, '+delta' if delta else '', '+shuffle' if shuffle else ''),
+                          lambda data: codec.encode(data, ITERATIONS), codec.decode, tiles)
+
+
+if __name__ == '__main__':
+    main()